@@ -1,34 +1,351 @@
+import asyncio
+import random
+
+import asyncpg
 from sanic import Sanic, response
 from sanic.log import logger
 from sanic.request import Request
 from sanic_cors import CORS
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
+from api.cache import LRUCache, get_catalog_state
+from api.catalog import load_catalog, refresh_catalog
+from api.compression import compress_response
+from api.metrics import (
+    REGISTRY,
+    collect_cache,
+    collect_pool,
+    instrument_engine,
+    request_finished,
+    request_started,
+    timed_pool,
+    write_snapshot,
+)
+from api.migrations import PROBLEMS_CHANNEL, upgrade
 from api.models import Base
 from api.settings import SANIC_CONFIG
 
+# Advisory lock taken while a worker creates and upgrades the schema
+SCHEMA_LOCK_KEY = 7_426_001
+
 app = Sanic("CodingInterviewQuestionsApp")
 app.config.update(SANIC_CONFIG)
 CORS(app, resources={r"/*": {"origins": app.config.DOMAIN}})
 
+# Per-worker cache of rendered /api/facets and /api/problems bodies, keyed by the
+# catalog version so entries go stale as soon as the ingestion task commits.
+app.ctx.result_cache = LRUCache(
+    app.config.RESULT_CACHE_SIZE, max_bytes=app.config.RESULT_CACHE_MAX_MB * 1024 * 1024
+)
+# Sitemap shards run to megabytes each, so they get their own budget
+app.ctx.sitemap_cache = LRUCache(
+    maxsize=16, max_bytes=app.config.SITEMAP_CACHE_MAX_MB * 1024 * 1024
+)
+# Rendered problem records by id. They don't depend on the catalog version, a record
+# is dropped when its row changes (see listen_for_changes) and expires after the TTL.
+app.ctx.problem_cache = LRUCache(
+    app.config.PROBLEM_CACHE_SIZE,
+    max_bytes=app.config.PROBLEM_CACHE_MAX_MB * 1024 * 1024,
+    ttl=app.config.PROBLEM_CACHE_TTL,
+)
+# gzip/brotli variants of the bodies above, keyed by (ETag, coding)
+app.ctx.compressed_cache = LRUCache(
+    app.config.RESULT_CACHE_SIZE + app.config.PROBLEM_CACHE_SIZE,
+    max_bytes=app.config.COMPRESSED_CACHE_MAX_MB * 1024 * 1024,
+)
+
+
+def collect_stats(_app) -> None:
+    """Read the cache counters and pool sizes of this worker into the metrics."""
+    for name in ("result_cache", "sitemap_cache", "problem_cache", "compressed_cache"):
+        collect_cache(name, getattr(_app.ctx, name))
+    if getattr(_app.ctx, "engine", None) is not None:
+        collect_pool("primary", _app.ctx.engine)
+        collect_pool("background", _app.ctx.background_engine)
+    if getattr(_app.ctx, "replica_engine", None) is not None:
+        collect_pool("replica", _app.ctx.replica_engine)
+
+
+REGISTRY.collectors.append(lambda: collect_stats(app))
+
+
+def pool_limits(workers: int, max_connections: int, reserved: int, background: int = 0) -> tuple:
+    """
+    Split the Postgres connection budget evenly across workers as (pool_size, max_overflow).
+
+    Each worker's share first loses the `background` connections it holds outside the
+    request pool (see background_connections). Three quarters of the rest stay open,
+    the others are overflow for bursts, so all workers at full overflow still fit in
+    max_connections minus `reserved`.
+    """
+    per_worker = max(1, (max_connections - reserved) // max(1, workers) - background)
+    pool_size = max(1, per_worker * 3 // 4)
+    return pool_size, per_worker - pool_size
+
+
+def background_connections(config) -> int:
+    """Connections a worker holds for its background tasks: LISTEN, and the catalog index."""
+    return 2 if config.CATALOG_INDEX else 1
+
+
+def maybe_recycle_worker(_app) -> None:
+    """Ask the worker manager to replace this worker once it served WORKER_MAX_REQUESTS."""
+    _app.ctx.requests_served += 1
+    if _app.ctx.requests_served != _app.ctx.recycle_after:
+        return
+    multiplexer = getattr(_app, "multiplexer", None)
+    if multiplexer is None:
+        return
+    # The replacement starts first, then this worker drains its open requests
+    logger.info("Recycling worker after %d requests.", _app.ctx.requests_served)
+    multiplexer.restart(zero_downtime=True)
+
+
+def database_url(host: str) -> str:
+    return (
+        "postgresql+asyncpg://"
+        f"{SANIC_CONFIG['DB_USER']}:{SANIC_CONFIG['DB_PASSWORD']}"
+        f"@{host}/{SANIC_CONFIG['DB_DATABASE']}"
+    )
+
+
+# Errors that mean the server or the connection to it is gone, not that one query failed
+CONNECTION_ERRORS = (
+    OSError,
+    asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.CannotConnectNowError,
+    asyncpg.exceptions.AdminShutdownError,
+    asyncpg.exceptions.InterfaceError,
+)
+
+
+def is_connection_error(exception: Exception) -> bool:
+    if isinstance(exception, DBAPIError):
+        if exception.connection_invalidated:
+            return True
+        # The asyncpg error is the cause of the DBAPI error SQLAlchemy wraps
+        exception = exception.orig.__cause__ or exception.orig
+    return isinstance(exception, CONNECTION_ERRORS)
+
+
+async def check_replica(_app) -> bool:
+    """Probe the read replica and route reads to the primary while it is unreachable."""
+
+    async def probe():
+        async with _app.ctx.replica_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    try:
+        await asyncio.wait_for(probe(), timeout=_app.config.DB_REPLICA_TIMEOUT)
+        healthy = True
+    except (OSError, DBAPIError, asyncio.TimeoutError) as e:
+        healthy = False
+        if _app.ctx.replica_healthy:
+            logger.warning("Read replica is down, reading from the primary: %s", e)
+
+    if healthy and not _app.ctx.replica_healthy:
+        logger.info("Read replica is up, routing reads to it.")
+    _app.ctx.replica_healthy = healthy
+    return healthy
+
+
+async def flush_metrics(_app) -> None:
+    """Write this worker's metrics to METRICS_DIR, where /metrics on any worker sums them."""
+    while True:
+        await asyncio.sleep(_app.config.METRICS_FLUSH_INTERVAL)
+        write_snapshot(_app.config.METRICS_DIR)
+
+
+async def monitor_replica(_app) -> None:
+    while True:
+        await check_replica(_app)
+        await asyncio.sleep(_app.config.DB_REPLICA_CHECK_INTERVAL)
+
+
+def on_problems_changed(_app, payload: str) -> None:
+    """Drop the records named in a PROBLEMS_CHANNEL notification, queue them for the index."""
+    if _app.ctx.catalog is not None:
+        _app.ctx.catalog_changes.append(payload)
+        _app.ctx.catalog_changed.set()
+
+    cache = _app.ctx.problem_cache
+    if payload == "*":
+        cache.clear()
+        return
+    for problem_id in payload.split(","):
+        cache.invalidate(int(problem_id))
+
+
+async def maintain_catalog(_app) -> None:
+    """
+    Apply PROBLEMS_CHANNEL notifications to the in-memory catalog.
+
+    Notifications that arrive during a refresh are applied together in the next one.
+    A None change asks to reload only if the catalog version moved, it is queued
+    when the listener (re)connects and may have missed notifications.
+    """
+    changes = _app.ctx.catalog_changes
+    while True:
+        await _app.ctx.catalog_changed.wait()
+        _app.ctx.catalog_changed.clear()
+        payloads = changes.copy()
+        changes.clear()
+        try:
+            reload = "*" in payloads
+            if None in payloads and not reload:
+                async with _app.ctx.background_engine.connect() as conn:
+                    version, _ = await get_catalog_state(conn)
+                reload = version != _app.ctx.catalog.version
+            if reload:
+                _app.ctx.catalog = await load_catalog(_app.ctx.background_engine)
+                logger.info("Reloaded the catalog index, %d problems.", len(_app.ctx.catalog))
+                continue
+
+            ids = {
+                int(problem_id)
+                for payload in payloads
+                if payload
+                for problem_id in payload.split(",")
+            }
+            if ids:
+                await refresh_catalog(_app.ctx.catalog, _app.ctx.background_engine, ids)
+        except (OSError, DBAPIError) as e:
+            logger.warning("Could not refresh the catalog index: %s", e)
+            changes.append("*")
+            _app.ctx.catalog_changed.set()
+            await asyncio.sleep(1)
+
+
+async def listen_for_changes(_app) -> None:
+    """
+    Hold a LISTEN connection to the primary for the lifetime of the worker.
+
+    Notifications are not delivered while the connection is down, so the record
+    cache is cleared and the catalog index re-checked whenever it is (re)established.
+    """
+    def callback(connection, pid, channel, payload):
+        on_problems_changed(_app, payload)
+
+    while True:
+        try:
+            async with _app.ctx.background_engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                driver = raw.driver_connection
+                await driver.add_listener(PROBLEMS_CHANNEL, callback)
+                _app.ctx.problem_cache.clear()
+                if _app.ctx.catalog is not None:
+                    _app.ctx.catalog_changes.append(None)
+                    _app.ctx.catalog_changed.set()
+                try:
+                    while not driver.is_closed():
+                        await asyncio.sleep(1)
+                finally:
+                    if not driver.is_closed():
+                        await driver.remove_listener(PROBLEMS_CHANNEL, callback)
+            logger.warning("Lost the %s listener connection, reconnecting.", PROBLEMS_CHANNEL)
+        except (OSError, DBAPIError) as e:
+            logger.warning("Could not listen on %s: %s", PROBLEMS_CHANNEL, e)
+            _app.ctx.problem_cache.clear()
+        await asyncio.sleep(1)
+
+
+def read_engine(_app):
+    """The engine read-only queries go to: the replica while it is healthy, else the primary."""
+    if _app.ctx.replica_healthy:
+        return _app.ctx.replica_engine
+    return _app.ctx.engine
+
+
+def get_session(request: Request, readonly: bool = False) -> AsyncSession:
+    """
+    Return the request's session, opening it on first use.
+
+    Requests that never query the database don't open one. The first call decides
+    the engine, so handlers that write must not call it with readonly=True.
+    """
+    session = getattr(request.ctx, "session", None)
+    if session is None:
+        engine = read_engine(request.app) if readonly else request.app.ctx.engine
+        session = request.ctx.session = AsyncSession(engine, expire_on_commit=False)
+    return session
+
 
 @app.listener("before_server_start")
 async def setup_db(_app, loop):
+    background = background_connections(_app.config)
+    pool_size, max_overflow = pool_limits(
+        _app.state.workers,
+        _app.config.DB_MAX_CONNECTIONS,
+        _app.config.DB_RESERVED_CONNECTIONS,
+        background,
+    )
     _app.ctx.engine = create_async_engine(
-        "postgresql+asyncpg://"
-        f"{SANIC_CONFIG['DB_USER']}:{SANIC_CONFIG['DB_PASSWORD']}"
-        f"@{SANIC_CONFIG['DB_HOST']}/{SANIC_CONFIG['DB_DATABASE']}",
-        pool_size=5,
+        database_url(SANIC_CONFIG["DB_HOST"]),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        poolclass=timed_pool("primary"),
+    )
+    instrument_engine(_app.ctx.engine, _app.config.METRICS_TRACE_QUERIES)
+    # The LISTEN and catalog connections are held for minutes, apart from request traffic
+    _app.ctx.background_engine = create_async_engine(
+        database_url(SANIC_CONFIG["DB_HOST"]),
+        pool_size=background,
+        max_overflow=0,
+        poolclass=timed_pool("background"),
     )
 
-    # Create tables on server startup
+    # The replica gets its own pool, sized from its own connection budget
+    _app.ctx.replica_engine = None
+    _app.ctx.replica_healthy = False
+    if _app.config.DB_REPLICA_HOST:
+        pool_size, max_overflow = pool_limits(
+            _app.state.workers,
+            _app.config.DB_REPLICA_MAX_CONNECTIONS,
+            _app.config.DB_RESERVED_CONNECTIONS,
+        )
+        _app.ctx.replica_engine = create_async_engine(
+            database_url(_app.config.DB_REPLICA_HOST),
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=True,
+            poolclass=timed_pool("replica"),
+        )
+        instrument_engine(_app.ctx.replica_engine, _app.config.METRICS_TRACE_QUERIES)
+        await check_replica(_app)
+        _app.add_task(monitor_replica(_app), name="monitor_replica")
+
+    # Jitter the limit so workers started together are not recycled together
+    max_requests = _app.config.WORKER_MAX_REQUESTS
+    _app.ctx.requests_served = 0
+    _app.ctx.recycle_after = (
+        max_requests + random.randint(0, max_requests // 10) if max_requests > 0 else 0
+    )
+
+    # Create tables on server startup, one worker at a time
     async with _app.ctx.engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
         await conn.run_sync(Base.metadata.create_all)
+        features = await conn.run_sync(upgrade)
+    _app.ctx.trigram_search = features["trigram_search"]
+
+    _app.ctx.catalog = None
+    if _app.config.CATALOG_INDEX:
+        _app.ctx.catalog = await load_catalog(_app.ctx.background_engine)
+        _app.ctx.catalog_changes = []
+        _app.ctx.catalog_changed = asyncio.Event()
+        _app.add_task(maintain_catalog(_app), name="maintain_catalog")
+        logger.info("Loaded the catalog index, %d problems.", len(_app.ctx.catalog))
+    _app.add_task(listen_for_changes(_app), name="listen_for_changes")
+    if _app.config.METRICS_DIR:
+        _app.add_task(flush_metrics(_app), name="flush_metrics")
 
 
 @app.middleware("request")
 async def on_request(request: Request) -> None:
-    request.ctx.session = AsyncSession(request.app.ctx.engine, expire_on_commit=False)
+    maybe_recycle_worker(request.app)
+    request_started(request)
 
 
 @app.middleware("response")
@@ -48,18 +365,46 @@ async def on_response(request: Request, response) -> None:
             await session.close()
 
 
+@app.middleware("response")
+async def compress(request: Request, response) -> None:
+    compress_response(request, response, request.app.ctx.compressed_cache)
+
+
+@app.middleware("response")
+async def record_metrics(request: Request, response) -> None:
+    request_finished(request, response)
+
+
 @app.listener("after_server_stop")
 async def close_db(_app, loop):
-    # Dispose engine on server shutdown
+    # Stop the background tasks and dispose engines on server shutdown
+    for name in ("listen_for_changes", "maintain_catalog", "monitor_replica", "flush_metrics"):
+        await _app.cancel_task(name, raise_exception=False)
+    _app.purge_tasks()
+    if _app.config.METRICS_DIR:
+        write_snapshot(_app.config.METRICS_DIR)
     await _app.ctx.engine.dispose()
+    await _app.ctx.background_engine.dispose()
+    if _app.ctx.replica_engine is not None:
+        await _app.ctx.replica_engine.dispose()
 
 
 @app.exception(Exception)
 async def exception_handler(
-    _request: Request, exception: Exception, **__
+    request: Request, exception: Exception, **__
 ) -> response.HTTPResponse:
     """Exception handler returns error in json format."""
     status_code = getattr(exception, "status_code", 500)
+
+    # Don't wait for the next health check to stop sending reads to a failed replica
+    session = getattr(request.ctx, "session", None)
+    if (
+        is_connection_error(exception)
+        and session is not None
+        and session.bind is request.app.ctx.replica_engine
+    ):
+        logger.warning("Read replica query failed, reading from the primary.")
+        request.app.ctx.replica_healthy = False
     error = " ".join(str(arg) for arg in exception.args)
 
     if status_code == 500:
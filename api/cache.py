@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+from sqlalchemy import select
+
+from api.models import CatalogVersion
+
+CATALOG_VERSION_ID = 1
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used entry and counts hits.
+
+    Bounded by entry count and, with max_bytes, by the total len() of the values,
+    which are the serialized response bodies. A value over max_bytes is not stored.
+    With ttl, entries also expire that many seconds after they were set.
+    """
+
+    def __init__(
+        self, maxsize: int = 1024, max_bytes: Optional[int] = None, ttl: Optional[float] = None
+    ):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._expires = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and self._expires[key] <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        size = len(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = value
+            self.bytes += size
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            while len(self._data) > self.maxsize or (
+                self.max_bytes is not None and self.bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key) -> None:
+        self.bytes -= len(self._data.pop(key))
+        self._expires.pop(key, None)
+
+    def invalidate(self, key) -> None:
+        """Drop one entry, e.g. when the row it was rendered from changed."""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+class DiskCache:
+    """
+    A directory of JSON files named by their key, bounded to max_bytes in total.
+
+    Files are replaced atomically so concurrent writers never leave a partial entry.
+    A hit refreshes the file's mtime, eviction removes the oldest files first.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _entries(self):
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries if entry.name.endswith(".json")]
+
+    def get(self, key: str, default=None):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            value = default
+        except ValueError:
+            logging.warning("Dropping unreadable cache entry %s.", path)
+            os.remove(path)
+            value = default
+        with self._lock:
+            if value is default:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value) -> None:
+        data = json.dumps(value, ensure_ascii=False).encode()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Remove the least recently used entries until the cache is at 90% of max_bytes."""
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        self._size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+
+async def get_catalog_state(session):
+    """Return (version, updated_at) of the catalog, (0, None) until the first ingestion run."""
+    result = await session.execute(
+        select(CatalogVersion.version, CatalogVersion.updated_at).where(
+            CatalogVersion.id == CATALOG_VERSION_ID
+        )
+    )
+    row = result.first()
+    if row is None:
+        return 0, None
+    return row.version, row.updated_at
@@ -0,0 +1,224 @@
+"""
+In-memory bitset index of the catalog for filtering and faceting without Postgres.
+
+Every facet value (a company, a difficulty, a data structure, ...) maps to a Python
+int used as a bitset, bit n set when problem id n has that value. Filters become
+bitwise AND/OR, facet counts are popcounts, and pages are read off the set bits in
+id order. Statements and rendered bodies stay in Postgres, only ids live here.
+"""
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import select
+
+from api.cache import get_catalog_state
+from api.facets import ARRAY_FACETS, FACETS, SCALAR_FACETS, collect_facets
+from api.models import Problem
+
+FacetRow = namedtuple("FacetRow", "facet value cnt")
+
+# Filter params and the facet they select on
+FILTER_FACETS = {
+    "company": "company",
+    "difficulty": "difficulty",
+    "data_structure": "data_structures",
+    "algorithm": "algorithms",
+    "tag": "tags",
+}
+
+# Page extraction looks at this many bits of the (shifted) bitset at a time
+CHUNK_BITS = 4096
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+LOAD_BATCH_SIZE = 10000
+
+
+def bits_from_ids(ids) -> int:
+    """Build a bitset from integer ids in linear time."""
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for problem_id in ids:
+        buffer[problem_id >> 3] |= 1 << (problem_id & 7)
+    return int.from_bytes(buffer, "little")
+
+
+def select_bit(bits: int, k: int) -> int:
+    """Position of the k-th (0-based) set bit counted from the lowest, by binary search."""
+    low, high = 0, bits.bit_length()
+    while low < high:
+        middle = (low + high) // 2
+        if (bits & ((1 << (middle + 1)) - 1)).bit_count() > k:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def iter_ascending(bits: int):
+    """Yield set bit positions from the lowest up."""
+    start = 0
+    while bits:
+        # Jump over runs of zeros, then walk a small chunk bit by bit
+        skip = (bits & -bits).bit_length() - 1
+        bits >>= skip
+        start += skip
+        chunk = bits & CHUNK_MASK
+        while chunk:
+            lowest = chunk & -chunk
+            yield start + lowest.bit_length() - 1
+            chunk ^= lowest
+        bits >>= CHUNK_BITS
+        start += CHUNK_BITS
+
+
+def iter_descending(bits: int):
+    """Yield set bit positions from the highest down."""
+    while bits:
+        shift = max(0, bits.bit_length() - CHUNK_BITS)
+        chunk = bits >> shift
+        while chunk:
+            highest = chunk.bit_length() - 1
+            yield shift + highest
+            chunk ^= 1 << highest
+        bits &= (1 << shift) - 1
+
+
+class CatalogIndex:
+    """
+    Bitsets of every facet value plus the catalog version they were read at.
+
+    Built with load_catalog() and kept current with apply_rows(). All methods are
+    synchronous, so a request never sees a half applied refresh.
+    """
+
+    def __init__(self, version: int = 0, updated_at=None):
+        self.version = version
+        self.updated_at = updated_at
+        self.all = 0
+        self.bitsets = {name: {} for name in FACETS}
+
+    def __len__(self):
+        return self.all.bit_count()
+
+    def apply_rows(self, rows, changed_ids=()) -> None:
+        """
+        Index (id, company, difficulty, data_structures, algorithms, tags) rows.
+
+        Ids in `changed_ids` are cleared first, so updated rows move to their new
+        values and ids that are in `changed_ids` but not in `rows` are deleted.
+        """
+        cleared = bits_from_ids(changed_ids)
+        if cleared:
+            self.all &= ~cleared
+            for values in self.bitsets.values():
+                for value in list(values):
+                    values[value] &= ~cleared
+                    if not values[value]:
+                        del values[value]
+
+        ids = []
+        ids_by_value = {name: defaultdict(list) for name in FACETS}
+        for row in rows:
+            ids.append(row.id)
+            for name in SCALAR_FACETS:
+                # Enum columns come back as members, the API deals in their values
+                value = getattr(getattr(row, name), "value", getattr(row, name))
+                if value:
+                    ids_by_value[name][value].append(row.id)
+            for name in ARRAY_FACETS:
+                for value in getattr(row, name) or ():
+                    ids_by_value[name][value].append(row.id)
+
+        self.all |= bits_from_ids(ids)
+        for name, groups in ids_by_value.items():
+            values = self.bitsets[name]
+            for value, value_ids in groups.items():
+                values[value] = values.get(value, 0) | bits_from_ids(value_ids)
+
+    def match(self, args) -> int:
+        """Bitset of the problems matching the company/difficulty/array filter params."""
+        bits = self.all
+        match_all = args.get("match", "all") == "all"
+        for param, name in FILTER_FACETS.items():
+            values = args.getlist(param) if name in ARRAY_FACETS else [args.get(param)]
+            values = [value for value in values if value]
+            if not values:
+                continue
+            bitsets = [self.bitsets[name].get(value, 0) for value in values]
+            if name in SCALAR_FACETS or match_all:
+                for value_bits in bitsets:
+                    bits &= value_bits
+            else:
+                any_bits = 0
+                for value_bits in bitsets:
+                    any_bits |= value_bits
+                bits &= any_bits
+        return bits
+
+    def facets(self, bits: int) -> dict:
+        """Per-value counts of the problems in `bits`, in the /api/facets response shape."""
+        rows = []
+        for name in FACETS:
+            for value, value_bits in self.bitsets[name].items():
+                count = (value_bits & bits).bit_count()
+                if count:
+                    rows.append(FacetRow(name, value, count))
+        return collect_facets(rows)
+
+    @staticmethod
+    def page(bits: int, limit: int, offset: int = 0, descending: bool = False) -> list:
+        """Ids of one page of `bits` in id order."""
+        total = bits.bit_count()
+        if offset >= total:
+            return []
+        if descending:
+            # Drop everything above the offset-th highest bit
+            start = select_bit(bits, total - 1 - offset)
+            positions = iter_descending(bits & ((1 << (start + 1)) - 1))
+        else:
+            start = select_bit(bits, offset)
+            positions = iter_ascending(bits >> start << start)
+        page = []
+        for position in positions:
+            page.append(position)
+            if len(page) == limit:
+                break
+        return page
+
+    @staticmethod
+    def before(bits: int, problem_id: int) -> int:
+        return bits & ((1 << problem_id) - 1)
+
+    @staticmethod
+    def after(bits: int, problem_id: int) -> int:
+        return bits >> (problem_id + 1) << (problem_id + 1)
+
+
+def facet_columns():
+    return (Problem.id,) + tuple(getattr(Problem, name) for name in FACETS)
+
+
+async def load_catalog(engine) -> CatalogIndex:
+    """Read the facet columns of every problem, with the catalog version of the same snapshot."""
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="REPEATABLE READ")
+        async with conn.begin():
+            index = CatalogIndex(*await get_catalog_state(conn))
+            result = await conn.stream(select(*facet_columns()))
+            async for rows in result.partitions(LOAD_BATCH_SIZE):
+                index.apply_rows(rows)
+    return index
+
+
+async def refresh_catalog(index: CatalogIndex, engine, ids) -> None:
+    """Re-read the rows with the given ids (changed or deleted) into `index`."""
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="REPEATABLE READ")
+        async with conn.begin():
+            version, updated_at = await get_catalog_state(conn)
+            result = await conn.execute(
+                select(*facet_columns()).where(Problem.id.in_(list(ids)))
+            )
+            rows = result.all()
+    index.apply_rows(rows, changed_ids=ids)
+    index.version, index.updated_at = version, updated_at
@@ -0,0 +1,120 @@
+"""
+Content-Encoding negotiation for the JSON and XML responses.
+
+gzip is always available, brotli when the optional `brotli` package is installed.
+Compressed bodies are cached by (ETag, coding), so a body that is already cached or
+pre-rendered is compressed once per worker and not on every request.
+"""
+import gzip
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:  # optional, responses are gzip only without it
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/xml", "text/")
+
+
+def available_encodings() -> tuple:
+    """Supported codings, most preferred first."""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def parse_accept_encoding(header: str) -> dict:
+    """Map each coding in an Accept-Encoding header to its q-value."""
+    qvalues = {}
+    for item in header.split(","):
+        coding, *params = item.strip().lower().split(";")
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.strip()] = q
+    return qvalues
+
+
+def negotiate(header: Optional[str], encodings=None) -> Optional[str]:
+    """
+    Pick the coding to send for an Accept-Encoding header, None for identity.
+
+    The highest q-value wins, ties go to the order of `encodings`. A "*" entry
+    covers every coding the client did not list.
+    """
+    if not header:
+        return None
+    qvalues = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for coding in encodings or available_encodings():
+        q = qvalues.get(coding, qvalues.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(body: bytes, coding: str, config) -> bytes:
+    if coding == "br":
+        return brotli.compress(body, quality=config.BROTLI_QUALITY)
+    # mtime=0 keeps the output identical across workers and restarts
+    return gzip.compress(body, compresslevel=config.GZIP_LEVEL, mtime=0)
+
+
+def add_vary(response, header: str = "Accept-Encoding") -> None:
+    vary = response.headers.get("vary")
+    if not vary:
+        response.headers["Vary"] = header
+    elif header.lower() not in vary.lower():
+        response.headers["Vary"] = f"{vary}, {header}"
+
+
+def compress_response(request, response, cache) -> None:
+    """
+    Replace the body of a large enough text response with its compressed form.
+
+    Streamed responses (a sitemap cache miss) have no body yet and go out as is.
+    The compressed variant gets a weak ETag, the body differs byte for byte. Every
+    response of a compressible resource varies on Accept-Encoding, also when this one
+    is not compressed, since the next one for the same URL may be.
+    """
+    config = request.app.config
+    etag = response.headers.get("etag")
+    if response.status == 304:
+        # Only the negotiated endpoints send validators, so this stands in for such a 200
+        if etag:
+            add_vary(response)
+        # Repeat the weak validator the client got with a compressed 200
+        if etag and f"W/{etag}" in request.headers.get("if-none-match", ""):
+            response.headers["ETag"] = f"W/{etag}"
+        return
+
+    if response.status != 200 or not (response.content_type or "").startswith(
+        COMPRESSIBLE_TYPES
+    ):
+        return
+    add_vary(response)
+    body = response.body
+    if (
+        not body
+        or len(body) < config.COMPRESSION_MIN_BYTES
+        or "content-encoding" in response.headers
+    ):
+        return
+    coding = negotiate(request.headers.get("accept-encoding"))
+    if coding is None:
+        return
+
+    compressed = cache.get((etag, coding)) if etag else None
+    if compressed is None:
+        compressed = compress(body, coding, config)
+        if etag:
+            cache.set((etag, coding), compressed)
+    response.body = compressed
+    response.headers["Content-Encoding"] = coding
+    if etag and not etag.startswith("W/"):
+        response.headers["ETag"] = f"W/{etag}"
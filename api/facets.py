@@ -0,0 +1,66 @@
+from sqlalchemy import String, cast, func, literal, select, union_all
+
+from api.models import Problem
+
+# Scalar columns are grouped directly, JSONB array columns are unnested first.
+SCALAR_FACETS = ("company", "difficulty")
+ARRAY_FACETS = ("data_structures", "algorithms", "tags")
+FACETS = SCALAR_FACETS + ARRAY_FACETS
+
+DIFFICULTY_ORDER = {"Easy": 0, "Medium": 1, "Hard": 2}
+
+
+def build_facets_query(filters):
+    """
+    Build a single statement that returns (facet, value, count) rows for every facet.
+
+    The filtered rows are materialized once in a CTE, JSONB arrays are unnested
+    server-side, so only the per-value counts travel back to the application.
+    """
+    filtered = (
+        select(*(getattr(Problem, name) for name in FACETS))
+        .where(*filters)
+        .cte("filtered")
+    )
+
+    parts = []
+    for name in SCALAR_FACETS:
+        column = cast(filtered.c[name], String)
+        parts.append(
+            select(
+                literal(name).label("facet"),
+                column.label("value"),
+                func.count().label("cnt"),
+            )
+            .where(column.isnot(None), column != "")
+            .group_by(column)
+        )
+
+    for name in ARRAY_FACETS:
+        elements = select(
+            func.jsonb_array_elements_text(filtered.c[name]).label("value")
+        ).subquery()
+        parts.append(
+            select(
+                literal(name).label("facet"),
+                elements.c.value,
+                func.count().label("cnt"),
+            ).group_by(elements.c.value)
+        )
+
+    return union_all(*parts)
+
+
+def collect_facets(rows):
+    """Group (facet, value, count) rows into the response shape of /api/facets."""
+    facets = {name: [] for name in FACETS}
+    for row in rows:
+        facets[row.facet].append({"value": row.value, "count": row.cnt})
+
+    # Sort difficulties in order: Easy, Medium, Hard
+    facets["difficulty"].sort(key=lambda item: DIFFICULTY_ORDER.get(item["value"], 999))
+    # Most frequent first, ties by value so the SQL and catalog paths agree
+    for name in ARRAY_FACETS:
+        facets[name].sort(key=lambda x: (-x["count"], x["value"]))
+
+    return facets
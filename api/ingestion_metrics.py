@@ -0,0 +1,160 @@
+"""
+Per-stage timings and message counts of one ingestion run.
+
+The pipeline functions in api/tasks.py time their stages into an IngestionStats and
+count messages as they go. At the end of a run report() logs the totals and p50/p95
+of every stage as one JSON line and pushes them, as gauges of the last run, to the
+Prometheus Pushgateway at METRICS_PUSHGATEWAY_URL.
+"""
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import requests
+
+from api.metrics import CONTENT_TYPE, Gauge, Registry
+from api.settings import METRICS_PUSHGATEWAY_URL
+
+STAGES = ("imap_login", "imap_search", "imap_fetch", "parse", "dedup", "classify", "commit")
+COUNTERS = ("scanned", "duplicates", "classified", "inserted", "failed")
+PUSH_JOB = "coding_ingestion"
+PUSH_TIMEOUT = 5
+
+
+def percentile(values, q: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+class IngestionStats:
+    """
+    Stage durations and message counters of one run, safe to update from the
+    classification threads. snapshot() and merge() carry them between Celery tasks.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.durations = defaultdict(list)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.durations[stage].append(seconds)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "durations": {stage: list(values) for stage, values in self.durations.items()},
+                "counts": dict(self.counts),
+            }
+
+    def merge(self, snapshot: dict) -> None:
+        """Add the stages and counts of an earlier task of the same run."""
+        with self._lock:
+            self.started = min(self.started, snapshot["started"])
+            for stage, values in snapshot["durations"].items():
+                self.durations[stage].extend(values)
+            for name, value in snapshot["counts"].items():
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = {
+                stage: {
+                    "calls": len(values),
+                    "total": round(sum(values), 6),
+                    "p50": round(percentile(values, 0.5), 6),
+                    "p95": round(percentile(values, 0.95), 6),
+                }
+                for stage in STAGES + tuple(sorted(set(self.durations) - set(STAGES)))
+                if (values := self.durations.get(stage))
+            }
+            return {
+                "elapsed": round(time.time() - self.started, 3),
+                "counts": dict(self.counts),
+                "stages": stages,
+            }
+
+    def report(self) -> dict:
+        summary = self.summary()
+        logging.info("Ingestion run: %s", json.dumps(summary))
+        if METRICS_PUSHGATEWAY_URL:
+            push_summary(METRICS_PUSHGATEWAY_URL, summary)
+        return summary
+
+
+def render_summary(summary: dict) -> str:
+    """The summary of a run as Prometheus gauges."""
+    registry = Registry()
+    stage_seconds = Gauge(
+        "ingestion_stage_seconds",
+        "Stage durations of the last run, by quantile.",
+        ("stage", "quantile"),
+        registry=registry,
+    )
+    stage_total = Gauge(
+        "ingestion_stage_time_seconds",
+        "Time spent per stage in the last run.",
+        ("stage",),
+        registry=registry,
+    )
+    stage_calls = Gauge(
+        "ingestion_stage_calls",
+        "Timed calls per stage in the last run.",
+        ("stage",),
+        registry=registry,
+    )
+    messages = Gauge(
+        "ingestion_messages",
+        "Messages of the last run by outcome.",
+        ("outcome",),
+        registry=registry,
+    )
+    elapsed = Gauge("ingestion_duration_seconds", "Wall time of the last run.", registry=registry)
+    finished = Gauge(
+        "ingestion_last_run_timestamp_seconds", "When the last run finished.", registry=registry
+    )
+
+    for stage, values in summary["stages"].items():
+        stage_seconds.set(values["p50"], stage=stage, quantile="0.5")
+        stage_seconds.set(values["p95"], stage=stage, quantile="0.95")
+        stage_total.set(values["total"], stage=stage)
+        stage_calls.set(values["calls"], stage=stage)
+    for outcome, value in summary["counts"].items():
+        messages.set(value, outcome=outcome)
+    elapsed.set(summary["elapsed"])
+    finished.set(time.time())
+    return registry.render(registry.snapshot())
+
+
+def push_summary(url: str, summary: dict) -> None:
+    """Replace the metrics of PUSH_JOB on the Pushgateway, a failed push only logs."""
+    try:
+        res = requests.put(
+            f"{url.rstrip('/')}/metrics/job/{PUSH_JOB}",
+            data=render_summary(summary).encode(),
+            headers={"Content-Type": CONTENT_TYPE},
+            timeout=PUSH_TIMEOUT,
+        )
+        res.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.warning("Could not push ingestion metrics: %s", e)
@@ -0,0 +1,376 @@
+"""
+Prometheus metrics for the web workers, rendered in the text exposition format.
+
+Each worker records into its own REGISTRY: request latency and in-flight requests
+(from the app middleware), pool checkout waits and per-request SQL statement counts
+and time (from engine events), and cache and pool sizes read at scrape time.
+
+With several workers run.py sets METRICS_DIR. Every worker then writes a snapshot of
+its registry there every METRICS_FLUSH_INTERVAL seconds, and /metrics sums the
+snapshots, so a scrape that lands on any worker reports the whole server. Counters
+of workers that exited are folded into one file and kept, gauges only count live
+workers.
+"""
+import bisect
+import fcntl
+import json
+import logging
+import os
+import re
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+RETIRED_FILE = "retired.json"
+SNAPSHOT_FILE = re.compile(r"worker-(\d+)\.json")
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Label values tuple -> value, in the form snapshots store it
+        self.values = {}
+        (registry or REGISTRY).register(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value: float, **labels) -> None:
+        """Set a total that is counted elsewhere, like the cache hit counters."""
+        self.values[self.key(labels)] = value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS
+    ):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float, **labels) -> None:
+        # Stored as [per bucket counts (the last one is +Inf), sum]
+        key = self.key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        # Called before every snapshot, to read values kept elsewhere into gauges
+        self.collectors = []
+
+    def register(self, metric: Metric) -> None:
+        self.metrics[metric.name] = metric
+
+    def snapshot(self) -> dict:
+        """All values as {metric name: [[label values, value], ...]}, JSON serializable."""
+        for collector in self.collectors:
+            collector()
+        return {
+            name: [[list(key), value] for key, value in metric.values.items()]
+            for name, metric in self.metrics.items()
+        }
+
+    def merge(self, total: dict, snapshot: dict, gauges: bool = True) -> dict:
+        """Add the values of `snapshot` into `total`."""
+        for name, samples in snapshot.items():
+            metric = self.metrics.get(name)
+            if metric is None or (metric.type == "gauge" and not gauges):
+                continue
+            values = {tuple(key): value for key, value in total.get(name, [])}
+            for key, value in samples:
+                key = tuple(key)
+                if key not in values:
+                    values[key] = value
+                elif metric.type == "histogram":
+                    counts, sum_ = values[key]
+                    values[key] = [[a + b for a, b in zip(counts, value[0])], sum_ + value[1]]
+                else:
+                    values[key] = values[key] + value
+            total[name] = [[list(key), value] for key, value in values.items()]
+        return total
+
+    def render(self, snapshot: dict) -> str:
+        lines = []
+        for name, metric in self.metrics.items():
+            samples = snapshot.get(name)
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for key, value in sorted(samples):
+                labels = list(zip(metric.labelnames, key))
+                if metric.type != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                    continue
+                counts, sum_ = value
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = format_labels(labels + [("le", format_value(bound))])
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(sum_)}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time from routing a request to its response (streamed bodies excluded).",
+    ("route", "method"),
+)
+REQUESTS = Counter(
+    "http_requests_total", "Responses sent, by route and status.", ("route", "method", "status")
+)
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being handled.")
+REQUEST_QUERIES = Histogram(
+    "db_queries_per_request",
+    "SQL statements executed per request.",
+    ("route",),
+    buckets=QUERY_COUNT_BUCKETS,
+)
+REQUEST_QUERY_SECONDS = Histogram(
+    "db_query_seconds_per_request", "Time spent in SQL statements per request.", ("route",)
+)
+POOL_CHECKOUT = Histogram(
+    "db_pool_checkout_seconds",
+    "Wait for a pooled connection, including connecting a new one.",
+    ("pool",),
+)
+POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "Connections of the pool by state.", ("pool", "state")
+)
+STATEMENT_DURATION = Histogram(
+    "db_statement_duration_seconds",
+    "Duration of single SQL statements, with METRICS_TRACE_QUERIES only.",
+    ("statement",),
+)
+CACHE_HITS = Counter("cache_hits_total", "Cache lookups that found an entry.", ("cache",))
+CACHE_MISSES = Counter("cache_misses_total", "Cache lookups that found nothing.", ("cache",))
+CACHE_BYTES = Gauge("cache_bytes", "Size of the cached values.", ("cache",))
+CACHE_ENTRIES = Gauge("cache_entries", "Number of cached entries.", ("cache",))
+
+
+class RequestStats:
+    """SQL statements run on behalf of one request, filled in by the engine events."""
+
+    __slots__ = ("route", "queries", "seconds")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.queries = 0
+        self.seconds = 0.0
+
+
+current_request: ContextVar = ContextVar("current_request", default=None)
+
+
+def request_started(request) -> None:
+    request.ctx.started = time.perf_counter()
+    request.ctx.stats = RequestStats(request.uri_template or "unmatched")
+    current_request.set(request.ctx.stats)
+    IN_FLIGHT.inc()
+
+
+def request_finished(request, response) -> None:
+    started = getattr(request.ctx, "started", None)
+    if started is None:
+        # Failed before the request middleware ran, e.g. no route matched
+        route = request.uri_template or "unmatched"
+        REQUESTS.inc(route=route, method=request.method, status=response.status)
+        return
+    del request.ctx.started
+    IN_FLIGHT.dec()
+    stats = request.ctx.stats
+    REQUEST_DURATION.observe(
+        time.perf_counter() - started, route=stats.route, method=request.method
+    )
+    REQUESTS.inc(route=stats.route, method=request.method, status=response.status)
+    REQUEST_QUERIES.observe(stats.queries, route=stats.route)
+    REQUEST_QUERY_SECONDS.observe(stats.seconds, route=stats.route)
+
+
+def statement_label(statement: str) -> str:
+    """The verb and first table of a statement, a label that stays low cardinality."""
+    words = statement.split(None, 1)
+    verb = words[0].upper() if words else ""
+    table = re.search(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+([\w.\"]+)", statement, re.IGNORECASE)
+    return f"{verb} {table[1].strip(chr(34))}" if table else verb
+
+
+def instrument_engine(engine, trace_queries: bool = False) -> None:
+    """Time every statement of an (async) engine into the current request's stats."""
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.seconds += elapsed
+        if trace_queries:
+            STATEMENT_DURATION.observe(elapsed, statement=statement_label(statement))
+            logger.info(
+                "%.2f ms %s: %s",
+                elapsed * 1000,
+                stats.route if stats is not None else "-",
+                " ".join(statement.split())[:500],
+            )
+
+    def handle_error(exception_context):
+        started = exception_context.connection and exception_context.connection.info.get(
+            "query_started"
+        )
+        if started:
+            started.pop()
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine.sync_engine, "handle_error", handle_error)
+
+
+def timed_pool(name: str):
+    """An AsyncAdaptedQueuePool class that records checkout waits under `name`."""
+
+    class TimedQueuePool(AsyncAdaptedQueuePool):
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                POOL_CHECKOUT.observe(time.perf_counter() - started, pool=name)
+
+    return TimedQueuePool
+
+
+def collect_pool(name: str, engine) -> None:
+    pool = engine.sync_engine.pool
+    POOL_CONNECTIONS.set(pool.checkedout(), pool=name, state="checked_out")
+    POOL_CONNECTIONS.set(pool.checkedin(), pool=name, state="idle")
+
+
+def collect_cache(name: str, cache) -> None:
+    CACHE_HITS.set(cache.hits, cache=name)
+    CACHE_MISSES.set(cache.misses, cache=name)
+    CACHE_BYTES.set(cache.bytes, cache=name)
+    CACHE_ENTRIES.set(len(cache), cache=name)
+
+
+def read_snapshot(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path: str, data: dict) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def write_snapshot(directory: str, registry: Registry = REGISTRY) -> None:
+    os.makedirs(directory, exist_ok=True)
+    write_json(os.path.join(directory, f"worker-{os.getpid()}.json"), registry.snapshot())
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect_snapshots(directory: str, registry: Registry = REGISTRY) -> dict:
+    """Sum the snapshots of every worker, folding the ones of exited workers into RETIRED_FILE."""
+    write_snapshot(directory, registry)
+    with open(os.path.join(directory, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired_path = os.path.join(directory, RETIRED_FILE)
+        retired = read_snapshot(retired_path) or {}
+        total = {}
+        exited = []
+        for filename in os.listdir(directory):
+            match = SNAPSHOT_FILE.fullmatch(filename)
+            snapshot = match and read_snapshot(os.path.join(directory, filename))
+            if not snapshot:
+                continue
+            if pid_alive(int(match[1])):
+                registry.merge(total, snapshot)
+            else:
+                registry.merge(retired, snapshot, gauges=False)
+                exited.append(filename)
+        if exited:
+            write_json(retired_path, retired)
+            for filename in exited:
+                os.remove(os.path.join(directory, filename))
+    return registry.merge(total, retired)
+
+
+def render_metrics(directory: str = "", registry: Registry = REGISTRY) -> str:
+    snapshot = collect_snapshots(directory, registry) if directory else registry.snapshot()
+    return registry.render(snapshot)
@@ -0,0 +1,179 @@
+"""
+Idempotent schema upgrades run at server startup.
+
+``Base.metadata.create_all`` only creates missing tables, so columns and indexes
+added to existing tables are brought in here. Every step must be safe to re-run,
+and once applied must not take table locks again: this runs on every worker start.
+"""
+import hashlib
+import logging
+
+from sqlalchemy import bindparam, inspect, or_, select, text, update
+from sqlalchemy.exc import DBAPIError
+
+from api.models import (
+    DERIVED_COLUMNS,
+    PROBLEM_FIELDS,
+    SEARCH_VECTOR_SQL,
+    Problem,
+    derived_columns,
+)
+
+COLUMNS = {
+    "search_vector": f"tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR_SQL}) STORED",
+    "rendered": "text",
+    "rendered_summary": "text",
+    "content_hash": "varchar(64)",
+}
+
+# Sanic workers LISTEN here to drop cached records. The payload is the comma separated
+# ids of the changed rows, or "*" when a statement touched more than fit in a NOTIFY.
+PROBLEMS_CHANNEL = "problems_changed"
+NOTIFY_MAX_IDS = 500
+NOTIFY_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION notify_problems_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    changed integer;
+    ids text;
+BEGIN
+    SELECT count(*), string_agg(id::text, ',') INTO changed, ids
+    FROM (SELECT id FROM changed_rows LIMIT {NOTIFY_MAX_IDS + 1}) AS batch;
+    IF changed > {NOTIFY_MAX_IDS} THEN
+        ids := '*';
+    END IF;
+    IF changed > 0 THEN
+        PERFORM pg_notify('{PROBLEMS_CHANNEL}', ids);
+    END IF;
+    RETURN NULL;
+END $$
+"""
+NOTIFY_TRIGGERS = {
+    "problems_changed_insert": ("INSERT", "NEW"),
+    "problems_changed_update": ("UPDATE", "NEW"),
+    "problems_changed_delete": ("DELETE", "OLD"),
+}
+
+
+def backfill_derived_columns(conn, nullable) -> None:
+    """Fill the pre-rendered JSON and content hash of rows written before they existed."""
+    table = Problem.__table__
+    rows = conn.execute(
+        select(*(table.c[name] for name in PROBLEM_FIELDS)).where(
+            or_(*(table.c[name].is_(None) for name in DERIVED_COLUMNS))
+        )
+    ).mappings()
+    params = [
+        {"_id": row["id"], **{f"_{k}": v for k, v in derived_columns(row).items()}}
+        for row in rows
+    ]
+
+    if params:
+        conn.execute(
+            update(table)
+            .where(table.c.id == bindparam("_id"))
+            .values({name: bindparam(f"_{name}") for name in DERIVED_COLUMNS}),
+            params,
+        )
+        logging.info("Backfilled derived columns of %d problems.", len(params))
+
+    for name in nullable:
+        conn.execute(text(f"ALTER TABLE problems ALTER COLUMN {name} SET NOT NULL"))
+
+
+def resolve_duplicate_hashes(conn) -> None:
+    """
+    Make stored content hashes unique before the unique index is built.
+
+    Rows the old regexp dedup kept apart can normalize to the same statement. The
+    oldest row keeps the hash, the others get one derived from their id, so they
+    stay readable but no longer block the index. They are logged for manual review.
+    """
+    groups = conn.execute(
+        text(
+            "SELECT content_hash, array_agg(id ORDER BY id) AS ids FROM problems "
+            "GROUP BY content_hash HAVING count(*) > 1"
+        )
+    ).all()
+    params = []
+    for content_hash, ids in groups:
+        logging.warning("Problems %s have the same statement, keeping %d.", ids, ids[0])
+        for problem_id in ids[1:]:
+            unique_hash = hashlib.sha256(f"{content_hash}:{problem_id}".encode()).hexdigest()
+            params.append({"_id": problem_id, "_content_hash": unique_hash})
+
+    if params:
+        table = Problem.__table__
+        conn.execute(
+            update(table)
+            .where(table.c.id == bindparam("_id"))
+            .values(content_hash=bindparam("_content_hash")),
+            params,
+        )
+
+
+def enable_trigram_search(conn) -> bool:
+    """Create the pg_trgm title index if the extension is available."""
+    try:
+        with conn.begin_nested():
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_problems_title_trgm "
+                    "ON problems USING gin (title gin_trgm_ops)"
+                )
+            )
+    except DBAPIError as e:
+        logging.warning("pg_trgm is not available, partial title search disabled: %s", e.orig)
+        return False
+    return True
+
+
+def create_notify_triggers(conn) -> None:
+    """Install the statement-level triggers that NOTIFY PROBLEMS_CHANNEL on every write."""
+    existing = set(
+        conn.execute(
+            text("SELECT tgname FROM pg_trigger WHERE tgrelid = 'problems'::regclass")
+        ).scalars()
+    )
+    missing = [name for name in NOTIFY_TRIGGERS if name not in existing]
+    if not missing:
+        return
+
+    conn.execute(text(NOTIFY_FUNCTION))
+    for name in missing:
+        event, transition = NOTIFY_TRIGGERS[name]
+        conn.execute(
+            text(
+                f"CREATE TRIGGER {name} AFTER {event} ON problems "
+                f"REFERENCING {transition} TABLE AS changed_rows "
+                "FOR EACH STATEMENT EXECUTE FUNCTION notify_problems_changed()"
+            )
+        )
+
+
+def upgrade(conn) -> dict:
+    """Bring an existing database up to the current models, return enabled features."""
+    inspector = inspect(conn)
+    columns = {column["name"]: column for column in inspector.get_columns("problems")}
+    for name, definition in COLUMNS.items():
+        if name not in columns:
+            conn.execute(text(f"ALTER TABLE problems ADD COLUMN {name} {definition}"))
+
+    nullable = [
+        name for name in DERIVED_COLUMNS if name not in columns or columns[name]["nullable"]
+    ]
+    if nullable:
+        backfill_derived_columns(conn, nullable)
+
+    indexes = {index["name"] for index in inspector.get_indexes("problems")}
+    if "ix_problems_content_hash" not in indexes:
+        resolve_duplicate_hashes(conn)
+    for index in Problem.__table__.indexes:
+        if index.name not in indexes:
+            index.create(conn)
+    create_notify_triggers(conn)
+
+    if "ix_problems_title_trgm" in indexes:
+        return {"trigram_search": True}
+    return {"trigram_search": enable_trigram_search(conn)}
@@ -1,8 +1,23 @@
 import enum
+import hashlib
+import json
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Text, Enum
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Computed,
+    DateTime,
+    Enum,
+    Index,
+    Integer,
+    String,
+    Text,
+    event,
+    func,
+)
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from sqlalchemy.orm import deferred
 
 
 class DifficultyEnum(str, enum.Enum):
@@ -13,9 +28,62 @@ class DifficultyEnum(str, enum.Enum):
 
 Base = declarative_base()
 
+# Weighted full-text document: title ranks above the statement, hints and solution
+SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(problem, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(hints, '[]'::jsonb)), 'C') || "
+    "setweight(to_tsvector('english', coalesce(solution, '')), 'D')"
+)
+
+# Keys of Problem.to_dict(), in output order
+PROBLEM_FIELDS = (
+    "id",
+    "title",
+    "problem",
+    "company",
+    "source",
+    "difficulty",
+    "data_structures",
+    "algorithms",
+    "tags",
+    "time_complexity",
+    "space_complexity",
+    "passes_allowed",
+    "edge_cases",
+    "input_types",
+    "test_cases",
+    "output_types",
+    "hints",
+    "solution",
+    "code_solution",
+)
+
+# Lightweight subset used by problem listings
+SUMMARY_FIELDS = (
+    "id",
+    "title",
+    "company",
+    "source",
+    "difficulty",
+    "data_structures",
+    "algorithms",
+    "tags",
+    "time_complexity",
+    "space_complexity",
+)
+
 
 class Problem(Base):
     __tablename__ = "problems"
+    __table_args__ = (
+        Index("ix_problems_search_vector", "search_vector", postgresql_using="gin"),
+        # Default jsonb_ops serve both @> (match all) and ?| (match any)
+        Index("ix_problems_data_structures", "data_structures", postgresql_using="gin"),
+        Index("ix_problems_algorithms", "algorithms", postgresql_using="gin"),
+        Index("ix_problems_tags", "tags", postgresql_using="gin"),
+        Index("ix_problems_content_hash", "content_hash", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String, nullable=False)
@@ -37,6 +105,12 @@ class Problem(Base):
     hints = Column(JSONB, nullable=False)
     solution = Column(Text, nullable=False)
     code_solution = Column(Text, nullable=False)
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR_SQL, persisted=True)))
+    # Pre-serialized to_dict() output without the id, see render_problem()
+    rendered = deferred(Column(Text, nullable=False))
+    rendered_summary = deferred(Column(Text, nullable=False))
+    # sha256 of the whitespace-normalized statement, used for deduplication
+    content_hash = deferred(Column(String(64), nullable=False))
 
     def __repr__(self):
         return f"<Problem(id={self.id}, title='{self.title}')>"
@@ -64,3 +138,99 @@ class Problem(Base):
             "solution": self.solution,
             "code_solution": self.code_solution,
         }
+
+
+def render_problem(values) -> tuple:
+    """
+    Pre-serialize the full and summary JSON of a problem from its column values.
+
+    The id is left out because it is not known before the insert, readers put it
+    back with with_id(). Returns (rendered, rendered_summary).
+    """
+    def dumps(fields):
+        return json.dumps(
+            {name: values.get(name) for name in fields if name != "id"},
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+
+    return dumps(PROBLEM_FIELDS), dumps(SUMMARY_FIELDS)
+
+
+def with_id(problem_id: int, rendered: str) -> str:
+    """Put the id back in front of a rendered problem: '{"id":1,"title":...}'."""
+    return f'{{"id":{problem_id},{rendered[1:]}'
+
+
+def hash_problem_text(text: str) -> str:
+    """Hash a problem statement with all whitespace runs collapsed to single spaces."""
+    return hashlib.sha256(" ".join(text.split()).encode()).hexdigest()
+
+
+# Written together with the other columns by the ORM hooks below, insert_problems()
+# and update_problems() in api/tasks.py. A bare Core update(Problem) leaves them stale.
+DERIVED_COLUMNS = ("rendered", "rendered_summary", "content_hash")
+
+
+def derived_columns(values) -> dict:
+    """Columns computed from the others on write: the pre-rendered JSON and the dedup hash."""
+    rendered, rendered_summary = render_problem(values)
+    return {
+        "rendered": rendered,
+        "rendered_summary": rendered_summary,
+        "content_hash": hash_problem_text(values.get("problem") or ""),
+    }
+
+
+@event.listens_for(Problem, "before_insert")
+@event.listens_for(Problem, "before_update")
+def _fill_derived_columns(mapper, connection, target):
+    values = {name: getattr(target, name) for name in PROBLEM_FIELDS}
+    for name, value in derived_columns(values).items():
+        setattr(target, name, value)
+
+
+class CatalogVersion(Base):
+    """Single-row table, bumped by the ingestion task whenever problems change."""
+
+    __tablename__ = "catalog_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<CatalogVersion(version={self.version})>"
+
+
+class MailboxSync(Base):
+    """IMAP sync position, so the ingestion task only fetches mail it has not seen yet."""
+
+    __tablename__ = "mailbox_sync"
+
+    mailbox = Column(String, primary_key=True)
+    uidvalidity = Column(BigInteger, nullable=False)
+    last_uid = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<MailboxSync(mailbox='{self.mailbox}', last_uid={self.last_uid})>"
+
+
+class FailedMessage(Base):
+    """
+    An email that could not be classified or stored. It is fetched again on later runs
+    until it has failed MAX_MESSAGE_ATTEMPTS times, then kept here for manual review.
+    """
+
+    __tablename__ = "failed_messages"
+
+    mailbox = Column(String, primary_key=True)
+    uid = Column(BigInteger, primary_key=True)
+    uidvalidity = Column(BigInteger, nullable=False)
+    attempts = Column(Integer, nullable=False, default=1)
+    error = Column(Text)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<FailedMessage(mailbox='{self.mailbox}', uid={self.uid}, attempts={self.attempts})>"
@@ -1,10 +1,101 @@
+import functools
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 
 SITE_ENV_PREFIX = "CODING"
 
 
+# Instance metadata endpoints returning every custom attribute as one JSON object
+METADATA_SOURCES = {
+    "oci": (
+        "http://169.254.169.254/opc/v2/instance/metadata/",
+        {"Authorization": "Bearer Oracle"},
+    ),
+    "gcp": (
+        "http://metadata.google.internal/computeMetadata/v1/instance/attributes/?recursive=true",
+        {"Metadata-Flavor": "Google"},
+    ),
+}
+METADATA_TIMEOUT = 2
+# Resolved attributes are kept on disk so restarts skip the probes
+METADATA_CACHE_FILE = os.environ.get(
+    f"{SITE_ENV_PREFIX}_METADATA_CACHE_FILE",
+    os.path.expanduser("~/.cache/coding/metadata.json"),
+)
+METADATA_CACHE_TTL = int(os.environ.get(f"{SITE_ENV_PREFIX}_METADATA_CACHE_TTL", "3600"))
+# When no provider answered, which is also what a failed probe on a cloud box looks like
+METADATA_EMPTY_CACHE_TTL = int(
+    os.environ.get(f"{SITE_ENV_PREFIX}_METADATA_EMPTY_CACHE_TTL", "60")
+)
+
+
+def fetch_metadata(provider: str) -> dict:
+    url, headers = METADATA_SOURCES[provider]
+    res = requests.get(url, headers=headers, timeout=METADATA_TIMEOUT)
+    res.raise_for_status()
+    return {name: str(value).strip() for name, value in res.json().items()}
+
+
+def detect_metadata():
+    """
+    Probe every provider concurrently and return (provider, attributes) of the first
+    that answers, (None, {}) off-cloud. Slower probes are abandoned, not awaited.
+    """
+    executor = ThreadPoolExecutor(max_workers=len(METADATA_SOURCES))
+    futures = {executor.submit(fetch_metadata, name): name for name in METADATA_SOURCES}
+    try:
+        for future in as_completed(futures):
+            try:
+                return futures[future], future.result()
+            except (requests.exceptions.RequestException, ValueError, AttributeError):
+                continue
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return None, {}
+
+
+def read_metadata_cache():
+    try:
+        with open(METADATA_CACHE_FILE) as f:
+            cached = json.load(f)
+        ttl = METADATA_CACHE_TTL if cached["provider"] else METADATA_EMPTY_CACHE_TTL
+        if time.time() - cached["fetched_at"] < ttl:
+            return cached["attributes"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_metadata_cache(provider, attributes: dict) -> None:
+    # The attributes hold credentials, so the file is only readable by its owner
+    try:
+        os.makedirs(os.path.dirname(METADATA_CACHE_FILE), exist_ok=True)
+        tmp_path = f"{METADATA_CACHE_FILE}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            cached = {"provider": provider, "attributes": attributes, "fetched_at": time.time()}
+            json.dump(cached, f)
+        os.replace(tmp_path, METADATA_CACHE_FILE)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=None)
+def metadata_attributes() -> dict:
+    """Cloud instance attributes, resolved at most once per METADATA_CACHE_TTL."""
+    attributes = read_metadata_cache()
+    if attributes is None:
+        provider, attributes = detect_metadata()
+        # Off-cloud results are cached too, for METADATA_EMPTY_CACHE_TTL only, so dev
+        # boxes skip most probes and a probe that failed on a cloud box is retried soon
+        write_metadata_cache(provider, attributes)
+    return attributes
+
+
 def get_env_var(name: str, default: str = "") -> str:
     """Get sensitive data from env vars, Oracle Cloud IMDS, or Google Cloud metadata."""
     name = f"{SITE_ENV_PREFIX}_{name}"
@@ -12,32 +103,12 @@ def get_env_var(name: str, default: str = "") -> str:
     env_var = os.environ.get(name)
     if env_var is not None:
         return env_var
+    return metadata_attributes().get(name, default)
 
-    # Try Oracle Cloud IMDS (only reachable on OCI instances)
-    try:
-        res = requests.get(
-            f"http://169.254.169.254/opc/v2/instance/metadata/{name}",
-            headers={"Authorization": "Bearer Oracle"},
-            timeout=2,
-        )
-        if res.status_code == 200:
-            return res.text.strip()
-    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
-        pass
-
-    # Try Google Cloud metadata (only reachable on GCP instances)
-    try:
-        res = requests.get(
-            f"http://metadata.google.internal/computeMetadata/v1/instance/attributes/{name}",
-            headers={"Metadata-Flavor": "Google"},
-            timeout=2,
-        )
-        if res.status_code == 200:
-            return res.text.strip()
-    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
-        pass
 
-    return default
+def get_setting(name: str, default: str = "") -> str:
+    """Get a non-secret tunable from env vars only, never from instance metadata."""
+    return os.environ.get(f"{SITE_ENV_PREFIX}_{name}", default)
 
 
 DEBUG = bool(get_env_var("DEBUG", "True"))
@@ -51,17 +122,70 @@ SANIC_CONFIG = {
     "DB_PASSWORD": get_env_var("DB_PASSWORD", ")e6`M94.F3.lE'i0}t-H"),
     "DB_HOST": get_env_var("DB_HOST", "127.0.0.1"),
     "DB_DATABASE": get_env_var("DB_NAME", "coding"),
+    # Optional streaming replica ("host" or "host:port") for the read-only endpoints
+    "DB_REPLICA_HOST": get_env_var("DB_REPLICA_HOST", ""),
+    "DB_REPLICA_MAX_CONNECTIONS": int(get_setting("DB_REPLICA_MAX_CONNECTIONS", "100")),
+    "DB_REPLICA_CHECK_INTERVAL": float(get_setting("DB_REPLICA_CHECK_INTERVAL", "5")),
+    "DB_REPLICA_TIMEOUT": float(get_setting("DB_REPLICA_TIMEOUT", "2")),
+    "RESULT_CACHE_SIZE": int(get_setting("RESULT_CACHE_SIZE", "1024")),
+    "RESULT_CACHE_MAX_MB": int(get_setting("RESULT_CACHE_MAX_MB", "64")),
+    "SITEMAP_CACHE_MAX_MB": int(get_setting("SITEMAP_CACHE_MAX_MB", "32")),
+    # Rendered /api/problems/<id> records, dropped on NOTIFY and after the TTL
+    "PROBLEM_CACHE_SIZE": int(get_setting("PROBLEM_CACHE_SIZE", "10000")),
+    "PROBLEM_CACHE_MAX_MB": int(get_setting("PROBLEM_CACHE_MAX_MB", "64")),
+    "PROBLEM_CACHE_TTL": float(get_setting("PROBLEM_CACHE_TTL", "300")),
+    # Answer /api/facets and /api/problems filters from in-memory bitsets, see api/catalog.py
+    "CATALOG_INDEX": get_setting("CATALOG_INDEX", "False") == "True",
+    # gzip (and brotli when installed) for JSON/XML bodies of at least COMPRESSION_MIN_BYTES
+    "COMPRESSION_MIN_BYTES": int(get_setting("COMPRESSION_MIN_BYTES", "1024")),
+    "COMPRESSED_CACHE_MAX_MB": int(get_setting("COMPRESSED_CACHE_MAX_MB", "64")),
+    "GZIP_LEVEL": int(get_setting("GZIP_LEVEL", "6")),
+    "BROTLI_QUALITY": int(get_setting("BROTLI_QUALITY", "5")),
+    "MAX_PAGE_SIZE": int(get_setting("MAX_PAGE_SIZE", "100")),
+    "CACHE_MAX_AGE": int(get_setting("CACHE_MAX_AGE", "300")),
+    # Production serving: Sanic workers sharing SOCKET_FILE, see run.py
+    "WEB_WORKERS": int(get_setting("WEB_WORKERS", str(os.cpu_count() or 1))),
+    "SOCKET_GROUP": get_setting("SOCKET_GROUP", "www-data"),
+    # Postgres max_connections, minus what Celery, migrations and psql need
+    "DB_MAX_CONNECTIONS": int(get_setting("DB_MAX_CONNECTIONS", "100")),
+    "DB_RESERVED_CONNECTIONS": int(get_setting("DB_RESERVED_CONNECTIONS", "10")),
+    # Replace a worker after this many requests (0 disables), drain for up to the timeout
+    "WORKER_MAX_REQUESTS": int(get_setting("WORKER_MAX_REQUESTS", "10000")),
+    "GRACEFUL_SHUTDOWN_TIMEOUT": float(get_setting("GRACEFUL_SHUTDOWN_TIMEOUT", "15")),
+    # /metrics: Prometheus text format, see api/metrics.py. Scrapes must send the token
+    # as a bearer token, without one the endpoint is off. METRICS_DIR is set by run.py
+    # for several workers.
+    "METRICS_TOKEN": get_env_var("METRICS_TOKEN", ""),
+    "METRICS_DIR": get_setting("METRICS_DIR", ""),
+    "METRICS_FLUSH_INTERVAL": float(get_setting("METRICS_FLUSH_INTERVAL", "5")),
+    # Time and log every SQL statement, not only the per-request totals
+    "METRICS_TRACE_QUERIES": get_setting("METRICS_TRACE_QUERIES", "False") == "True",
 }
 
 EMAIL = get_env_var("EMAIL")
 EMAIL_PASSWORD = get_env_var("EMAIL_PASSWORD")
+IMAP_HOST = get_setting("IMAP_HOST", "imap.mail.yahoo.com")
+IMAP_PORT = int(get_setting("IMAP_PORT", "993"))
+IMAP_SSL = get_setting("IMAP_SSL", "True") == "True"
 OPENAI_API_KEY = get_env_var("OPENAI_API_KEY")
 OPENAI_MODEL = "gpt-5.4-mini"  # "gpt-4.1-mini"
+# Any OpenAI-compatible endpoint, empty for api.openai.com
+OPENAI_BASE_URL = get_setting("OPENAI_BASE_URL") or None
+OPENAI_RPM = int(get_setting("OPENAI_RPM", "60"))  # requests per minute
+OPENAI_MAX_RETRIES = int(get_setting("OPENAI_MAX_RETRIES", "5"))
+CLASSIFY_CONCURRENCY = int(get_setting("CLASSIFY_CONCURRENCY", "4"))
+# Parsed classifications, keyed by problem text, prompt, model and schema. Empty disables it.
+CLASSIFICATION_CACHE_DIR = get_setting(
+    "CLASSIFICATION_CACHE_DIR", os.path.expanduser("~/.cache/coding/classifications")
+)
+CLASSIFICATION_CACHE_MAX_MB = int(get_setting("CLASSIFICATION_CACHE_MAX_MB", "256"))
+# Prometheus Pushgateway for the per-run ingestion metrics, empty only logs them
+METRICS_PUSHGATEWAY_URL = get_setting("METRICS_PUSHGATEWAY_URL", "")
 
 # CELERY STUFF
 CELERY_BROKER_URL = "redis://localhost:6379/10"
-CELERY_result_backend = "redis://localhost:6379/10"
-CELERY_accept_content = ["application/json"]
-CELERY_task_serializer = "json"
-CELERY_result_serializer = "json"
-CELERY_timezone = "UTC"
+CELERY_RESULT_BACKEND = "redis://localhost:6379/10"
+CELERY_ACCEPT_CONTENT = ["application/json"]
+CELERY_TASK_SERIALIZER = "json"
+CELERY_RESULT_SERIALIZER = "json"
+CELERY_TIMEZONE = "UTC"
@@ -1,19 +1,62 @@
+import base64
+import functools
+import hashlib
+import json
 import logging
+import quopri
+import random
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from typing import List, Optional
 
 import imaplib
 import email
 from email.header import decode_header
 
-from openai import OpenAI
-from pydantic import BaseModel
-from sqlalchemy import create_engine, exists, func, literal
+from celery import chord
+from openai import APIConnectionError, InternalServerError, OpenAI, RateLimitError
+import redis
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import bindparam, create_engine, delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
 
+from api.cache import CATALOG_VERSION_ID, DiskCache
 from api.celery_app import app
-from api.models import Problem, DifficultyEnum
-from api.settings import EMAIL, EMAIL_PASSWORD, OPENAI_API_KEY, OPENAI_MODEL, SANIC_CONFIG
+from api.ingestion_metrics import IngestionStats
+from api.models import (
+    DERIVED_COLUMNS,
+    PROBLEM_FIELDS,
+    CatalogVersion,
+    MailboxSync,
+    Problem,
+    DifficultyEnum,
+    FailedMessage,
+    derived_columns,
+    hash_problem_text,
+)
+from api.settings import (
+    CELERY_BROKER_URL,
+    CLASSIFICATION_CACHE_DIR,
+    CLASSIFICATION_CACHE_MAX_MB,
+    CLASSIFY_CONCURRENCY,
+    EMAIL,
+    EMAIL_PASSWORD,
+    IMAP_HOST,
+    IMAP_PORT,
+    IMAP_SSL,
+    OPENAI_API_KEY,
+    OPENAI_BASE_URL,
+    OPENAI_MAX_RETRIES,
+    OPENAI_MODEL,
+    OPENAI_RPM,
+    SANIC_CONFIG,
+)
 
 engine = create_engine(
     f"postgresql://{ SANIC_CONFIG['DB_USER'] }:{ SANIC_CONFIG['DB_PASSWORD'] }"
@@ -21,6 +64,20 @@ engine = create_engine(
 )
 Session = sessionmaker(bind=engine)
 
+MAILBOX = "INBOX"
+FETCH_BATCH_SIZE = 50
+DEDUP_BATCH_SIZE = 100
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_SECONDS = 5.0
+# Emails that fail this many runs are no longer fetched, see FailedMessage
+MAX_MESSAGE_ATTEMPTS = 3
+IMAP_ATOM = re.compile(rb'[^ ()"]+')
+SUBJECT_SEARCH = 'SUBJECT "Daily Coding Problem: Problem #"'
+
+# 429, 5xx and connection/timeout errors are worth another attempt
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+RETRY_BACKOFF = 1.0  # seconds, doubled on every attempt
+
 SYSTEM_PROMPT = """
 You are an AI assistant that classifies coding problems into structured data.
 
@@ -149,6 +206,164 @@ def classify_problem(client: OpenAI, problem: str) -> ProblemSchema:
     return response
 
 
+class RateLimiter:
+    """Spaces calls out evenly so that at most `per_minute` start per minute, across threads."""
+
+    def __init__(self, per_minute: int):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class RedisRateLimiter:
+    """
+    RateLimiter whose schedule lives in Redis, so every Celery worker draws from the same
+    per-minute budget. Slots are handed out by a script using the Redis clock.
+    """
+
+    # Returns the delay in microseconds until the caller's slot
+    SCRIPT = """
+    local now = redis.call("TIME")
+    now = tonumber(now[1]) * 1000000 + tonumber(now[2])
+    local interval = tonumber(ARGV[1])
+    local slot = math.max(tonumber(redis.call("GET", KEYS[1]) or now), now)
+    redis.call("SET", KEYS[1], slot + interval, "PX", math.ceil((slot + interval - now) / 1000) + 1000)
+    return slot - now
+    """
+
+    def __init__(self, client, per_minute: int, key: str = "coding:openai-rate-limit"):
+        self.interval = int(60_000_000 / per_minute) if per_minute > 0 else 0
+        self.key = key
+        self._script = client.register_script(self.SCRIPT)
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        delay = self._script(keys=[self.key], args=[self.interval])
+        if delay > 0:
+            time.sleep(delay / 1_000_000)
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Honour Retry-After when the server sends it, otherwise back off exponentially."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    return RETRY_BACKOFF * 2**attempt * random.uniform(0.5, 1.0)
+
+
+def classify_with_retries(
+    client: OpenAI, problem: str, limiter: RateLimiter, max_retries: int = OPENAI_MAX_RETRIES
+) -> ProblemSchema:
+    for attempt in range(max_retries + 1):
+        limiter.wait()
+        try:
+            return classify_problem(client, problem)
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = retry_delay(e, attempt)
+            logging.warning("OpenAI request failed (%s), retrying in %.1fs.", e, delay)
+            time.sleep(delay)
+
+
+def classification_key(problem: str) -> str:
+    """Hash everything that determines a classification, so changing any of it is a miss."""
+    schema = json.dumps(ProblemSchema.model_json_schema(), sort_keys=True)
+    parts = (OPENAI_MODEL, SYSTEM_PROMPT, schema, problem)
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def classification_cache() -> Optional[DiskCache]:
+    if not CLASSIFICATION_CACHE_DIR:
+        return None
+    return DiskCache(CLASSIFICATION_CACHE_DIR, CLASSIFICATION_CACHE_MAX_MB * 1024 * 1024)
+
+
+def classify_cached(
+    client: OpenAI,
+    problem: str,
+    limiter: RateLimiter,
+    cache: Optional[DiskCache] = None,
+    force_refresh: bool = False,
+    max_retries: int = OPENAI_MAX_RETRIES,
+) -> ProblemSchema:
+    """Classify a problem, reusing a stored result unless force_refresh is set."""
+    if cache is None:
+        return classify_with_retries(client, problem, limiter, max_retries)
+
+    key = classification_key(problem)
+    if not force_refresh:
+        cached = cache.get(key)
+        if cached is not None:
+            try:
+                return ProblemSchema.model_validate(cached)
+            except ValidationError:
+                logging.warning("Ignoring invalid cached classification %s.", key)
+
+    result = classify_with_retries(client, problem, limiter, max_retries)
+    cache.set(key, result.model_dump(mode="json"))
+    return result
+
+
+def classify_in_order(
+    client: OpenAI,
+    items,
+    concurrency: int = CLASSIFY_CONCURRENCY,
+    limiter=None,
+    cache: Optional[DiskCache] = None,
+    force_refresh: bool = False,
+    stats: Optional[IngestionStats] = None,
+):
+    """
+    Classify (key, problem_text) items on a thread pool and yield (key, result, error)
+    in input order. Only 2 * concurrency items are in flight, `items` is consumed lazily.
+    """
+    limiter = limiter or RateLimiter(OPENAI_RPM)
+    stats = stats or IngestionStats()
+    pending = deque()
+
+    def classify(problem_text):
+        with stats.time("classify"):
+            return classify_cached(client, problem_text, limiter, cache, force_refresh)
+
+    def result(key, future):
+        try:
+            return key, future.result(), None
+        except Exception as e:
+            return key, None, e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for key, problem_text in items:
+            future = executor.submit(classify, problem_text)
+            pending.append((key, future))
+            if len(pending) >= 2 * concurrency:
+                yield result(*pending.popleft())
+        while pending:
+            yield result(*pending.popleft())
+
+
+def bump_catalog_version(session) -> None:
+    """Bump the catalog version so every Sanic worker drops its cached results."""
+    stmt = insert(CatalogVersion).values(id=CATALOG_VERSION_ID, version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CatalogVersion.id],
+        set_={"version": CatalogVersion.version + 1, "updated_at": func.now()},
+    )
+    session.execute(stmt)
+
+
 def extract_problem_body(body: str) -> str:
     candidates = [
         "This problem was recently asked by ",
@@ -175,89 +390,645 @@ def extract_problem_body(body: str) -> str:
     return body[start:stop].strip()
 
 
-def get_problems():
-    imap = imaplib.IMAP4_SSL("imap.mail.yahoo.com")
+def load_sync_state(session) -> dict:
+    """Return the stored IMAP sync position as {"uidvalidity": ..., "last_uid": ...}."""
+    state = session.get(MailboxSync, MAILBOX)
+    if state is None:
+        return {"uidvalidity": None, "last_uid": 0}
+    return {"uidvalidity": state.uidvalidity, "last_uid": state.last_uid}
+
+
+def save_sync_state(session, sync_state: dict) -> None:
+    if sync_state["uidvalidity"] is None:
+        return
+    stmt = insert(MailboxSync).values(mailbox=MAILBOX, **sync_state)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[MailboxSync.mailbox],
+        set_={**sync_state, "updated_at": func.now()},
+    )
+    session.execute(stmt)
+
+
+def load_retry_uids(session, sync_state: dict) -> list:
+    """UIDs of earlier failed emails that have attempts left, see FailedMessage."""
+    return list(
+        session.scalars(
+            select(FailedMessage.uid)
+            .where(
+                FailedMessage.mailbox == MAILBOX,
+                FailedMessage.uidvalidity == sync_state["uidvalidity"],
+                FailedMessage.attempts < MAX_MESSAGE_ATTEMPTS,
+            )
+            .order_by(FailedMessage.uid)
+        )
+    )
+
+
+def finish_sync(session, sync_state: dict, retry_uids, failures: dict) -> None:
+    """
+    Advance the sync position past every fetched email and remember the ones that failed,
+    so a message that keeps failing is fetched at most MAX_MESSAGE_ATTEMPTS times.
+    """
+    save_sync_state(session, sync_state)
+    session.execute(
+        delete(FailedMessage).where(
+            FailedMessage.mailbox == MAILBOX,
+            or_(
+                FailedMessage.uidvalidity != sync_state["uidvalidity"],
+                FailedMessage.uid.in_(set(retry_uids) - set(failures)),
+            ),
+        )
+    )
+
+    for uid, error in failures.items():
+        stmt = insert(FailedMessage).values(
+            mailbox=MAILBOX,
+            uid=uid,
+            uidvalidity=sync_state["uidvalidity"],
+            error=str(error),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FailedMessage.mailbox, FailedMessage.uid],
+            set_={
+                "attempts": FailedMessage.attempts + 1,
+                "error": stmt.excluded.error,
+                "updated_at": func.now(),
+            },
+        ).returning(FailedMessage.attempts)
+        attempts = session.execute(stmt).scalar_one()
+        if attempts >= MAX_MESSAGE_ATTEMPTS:
+            logging.error(f"Giving up on IMAP message {uid} after {attempts} attempts.")
+    session.commit()
+
+    if failures:
+        logging.warning(f"{len(failures)} problems failed, they are retried on the next run.")
+
+
+def imap_connect():
+    imap_class = imaplib.IMAP4_SSL if IMAP_SSL else imaplib.IMAP4
+    imap = imap_class(IMAP_HOST, IMAP_PORT)
     try:
         imap.login(EMAIL, EMAIL_PASSWORD)
     except imaplib.IMAP4.error as e:
         raise Exception("IMAP login failed") from e
+    return imap
+
+
+def parse_imap_list(data: bytes, pos: int = 0):
+    """
+    Parse one parenthesized IMAP list (e.g. a BODYSTRUCTURE) starting at data[pos].
+    Returns (value, end) where value is a nested list of str / None.
+    """
+    stack, value = [], None
+    while pos < len(data):
+        char = data[pos : pos + 1]
+        if char == b"(":
+            stack.append([])
+            pos += 1
+        elif char == b")":
+            value = stack.pop()
+            pos += 1
+            if not stack:
+                return value, pos
+            stack[-1].append(value)
+        elif char == b" ":
+            pos += 1
+        elif char == b'"':
+            end = pos + 1
+            while data[end : end + 1] != b'"':
+                end += 2 if data[end : end + 1] == b"\\" else 1
+            token = re.sub(rb"\\(.)", rb"\1", data[pos + 1 : end])
+            stack[-1].append(token.decode("utf-8", "replace"))
+            pos = end + 1
+        elif char == b"{" or not stack:
+            raise ValueError("Unsupported IMAP list.")
+        else:
+            match = IMAP_ATOM.match(data, pos)
+            token = match.group().decode()
+            stack[-1].append(None if token.upper() == "NIL" else token)
+            pos = match.end()
+    raise ValueError("Unterminated IMAP list.")
+
+
+def find_text_part(structure, prefix: str = ""):
+    """
+    Return (part, encoding, charset) of the first text/plain part in a BODYSTRUCTURE,
+    or None when the message has none.
+    """
+    if isinstance(structure[0], list):
+        # Multipart: child parts come first, followed by the subtype and extensions
+        for number, child in enumerate(structure, start=1):
+            if not isinstance(child, list):
+                break
+            found = find_text_part(child, f"{prefix}{number}.")
+            if found:
+                return found
+        return None
+
+    if (structure[0] or "").lower() != "text" or (structure[1] or "").lower() != "plain":
+        return None
+    params = structure[2] or []
+    params = dict(zip(map(str.lower, params[::2]), params[1::2]))
+    return prefix.rstrip(".") or "1", (structure[5] or "7bit").lower(), params.get("charset")
+
+
+def fetch_responses(msg_data) -> dict:
+    """
+    Group the response of a multi-message UID FETCH by UID.
+    Returns {uid: (metadata, [literals])}, metadata being the non-literal bytes.
+    """
+    messages, current = {}, None
+    for item in msg_data:
+        meta, literal = (item[0], item[1]) if isinstance(item, tuple) else (item, None)
+        if re.match(rb"\d+ \(", meta):
+            current = [b"", []]
+            messages[len(messages)] = current
+        if current is None:
+            continue
+        current[0] += meta
+        if literal is not None:
+            current[1].append(literal)
+
+    by_uid = {}
+    for meta, literals in messages.values():
+        match = re.search(rb"UID (\d+)", meta)
+        if match:
+            by_uid[int(match.group(1))] = (meta, literals)
+    return by_uid
+
+
+def decode_part(payload: bytes, encoding: str, charset: Optional[str]) -> str:
+    if encoding == "base64":
+        payload = base64.b64decode(payload)
+    elif encoding == "quoted-printable":
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset or "utf-8", "replace")
+    except LookupError:
+        logging.warning(f"Unknown charset {charset!r}, decoding as utf-8.")
+        return payload.decode("utf-8", "replace")
+
+
+def decode_subject(raw_header: bytes) -> str:
+    msg = email.message_from_bytes(raw_header)
+    subject, encoding = decode_header(msg["Subject"] or "")[0]
+    if isinstance(subject, bytes):
+        subject = subject.decode(encoding or "utf-8")
+    return subject.strip()
+
+
+def parse_full_message(raw: bytes):
+    """Return (subject, text/plain body) of a complete RFC822 message."""
+    msg = email.message_from_bytes(raw)
+    for part in msg.walk():
+        if part.get_content_type() == "text/plain":
+            return decode_subject(raw), part.get_payload(decode=True).decode()
+    return decode_subject(raw), None
+
+
+def fetch_batch(imap, uids) -> dict:
+    """
+    Fetch subject and text/plain body for a batch of UIDs in a few round trips.
+
+    BODYSTRUCTURE tells which section holds the text/plain part, then only that
+    section is downloaded with BODY.PEEK. Messages whose structure cannot be read
+    are fetched whole. Returns {uid: (subject, body or None)}.
+    """
+    uid_set = ",".join(map(str, uids))
+    _, msg_data = imap.uid(
+        "FETCH", uid_set, "(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT)])"
+    )
+    results, sections, full = {}, {}, []
+    for uid, (meta, literals) in fetch_responses(msg_data).items():
+        try:
+            start = meta.index(b"BODYSTRUCTURE ") + len(b"BODYSTRUCTURE ")
+            structure, _ = parse_imap_list(meta, start)
+        except ValueError:
+            full.append(uid)
+            continue
+        if len(literals) != 1:
+            full.append(uid)
+            continue
+        subject = decode_subject(literals[0])
+        text_part = find_text_part(structure)
+        if text_part is None:
+            results[uid] = subject, None
+            continue
+        part, encoding, charset = text_part
+        sections.setdefault(part, []).append((uid, subject, encoding, charset))
+
+    # One round trip per distinct section number, usually just "1" or "1.1"
+    for part, messages in sections.items():
+        uid_set = ",".join(str(uid) for uid, *_ in messages)
+        _, msg_data = imap.uid("FETCH", uid_set, f"(UID BODY.PEEK[{part}])")
+        bodies = fetch_responses(msg_data)
+        for uid, subject, encoding, charset in messages:
+            literals = bodies.get(uid, (b"", []))[1]
+            body = decode_part(literals[0], encoding, charset) if literals else None
+            results[uid] = subject, body
+
+    if full:
+        _, msg_data = imap.uid("FETCH", ",".join(map(str, full)), "(UID RFC822)")
+        for uid, (_, literals) in fetch_responses(msg_data).items():
+            results[uid] = parse_full_message(literals[0])
+
+    return results
+
+
+def get_problems(
+    sync_state: Optional[dict] = None, retry_uids=(), stats: Optional[IngestionStats] = None
+):
+    """
+    Yield (uid, subject, problem body) of Daily Coding Problem emails, oldest first.
+
+    With `sync_state` only messages with a UID above its last_uid are fetched, plus the
+    `retry_uids` of earlier failures, and the dict is updated in place with the highest
+    UID seen. A changed UIDVALIDITY means the stored UIDs are meaningless, so the whole
+    mailbox is scanned again. Messages are fetched FETCH_BATCH_SIZE at a time, text/plain
+    section only.
+    """
+    if sync_state is None:
+        sync_state = {"uidvalidity": None, "last_uid": 0}
+    stats = stats or IngestionStats()
 
-    imap.select("INBOX")
-    _, msgnums = imap.search(None, 'SUBJECT "Daily Coding Problem: Problem #"')
-    msgnums = msgnums[0].decode("utf-8").split()
-    msgnums.reverse()  # process older messages first
+    with stats.time("imap_login"):
+        imap = imap_connect()
+        imap.select(MAILBOX)
+    _, data = imap.response("UIDVALIDITY")
+    uidvalidity = int(data[0])
+    if uidvalidity != sync_state["uidvalidity"]:
+        if sync_state["uidvalidity"] is not None:
+            logging.warning("IMAP UIDVALIDITY changed, resyncing the whole mailbox.")
+        sync_state.update(uidvalidity=uidvalidity, last_uid=0)
+        retry_uids = ()
+
+    last_uid = sync_state["last_uid"]
+    with stats.time("imap_search"):
+        _, uids = imap.uid("SEARCH", f"UID {last_uid + 1}:*", SUBJECT_SEARCH)
+    # "n:*" always matches the highest UID, even when it is below n
+    uids = {uid for uid in map(int, uids[0].split()) if uid > last_uid}
+    uids = sorted(uids.union(retry_uids))
     logging.debug(
-        f"Found {len(msgnums)} problems in mail with subject 'Daily Coding Problem'."
+        f"Found {len(uids)} new problems in mail with subject 'Daily Coding Problem'."
     )
 
-    for num in msgnums:
-        res, msg_data = imap.fetch(str(num), "(RFC822)")
-        for response in msg_data:
-            if isinstance(response, tuple):
-                msg = email.message_from_bytes(response[1])
-                subject, encoding = decode_header(msg["Subject"])[0]
-                if isinstance(subject, bytes):
-                    subject = subject.decode(encoding or "utf-8")
-                subject = subject.strip()
-
-                if "Daily Coding Problem" not in subject:
-                    raise Exception("Unexpected email subject format.")
-
-                for part in msg.walk():
-                    if part.get_content_type() == "text/plain":
-                        body = part.get_payload(decode=True).decode()
-                        try:
-                            extracted_body = extract_problem_body(body)
-                        except ValueError as e:
-                            logging.warning("Error extracting problem: %s", e)
-                            continue
-                        yield subject, extracted_body
-                        break
+    for start in range(0, len(uids), FETCH_BATCH_SIZE):
+        batch = uids[start : start + FETCH_BATCH_SIZE]
+        with stats.time("imap_fetch"):
+            messages = fetch_batch(imap, batch)
+        for uid in batch:
+            sync_state["last_uid"] = max(sync_state["last_uid"], uid)
+            stats.count("scanned")
+            if uid not in messages:
+                logging.warning(f"IMAP message {uid} was not returned by the server.")
+                stats.count("failed")
+                continue
+            subject, body = messages[uid]
+
+            if "Daily Coding Problem" not in subject:
+                raise Exception("Unexpected email subject format.")
+            if body is None:
+                logging.warning(f"No text/plain part in message: {subject}")
+                stats.count("failed")
+                continue
+
+            try:
+                with stats.time("parse"):
+                    extracted_body = extract_problem_body(body)
+            except ValueError as e:
+                logging.warning("Error extracting problem: %s", e)
+                stats.count("failed")
+                continue
+            yield uid, subject, extracted_body
     imap.close()
     imap.logout()
 
 
-@app.task()
-def get_new_problems():
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    problems_added = 0
+def parse_problems(sync_state=None, retry_uids=(), stats: Optional[IngestionStats] = None):
+    """Yield (uid, problem_id, cleaned_problem_text, problem_text) for every fetched email."""
+    stats = stats or IngestionStats()
+    for uid, subject, problem_text in get_problems(sync_state, retry_uids, stats):
+        match = re.search(r"Problem #(\d+)", subject)
+        if not match:
+            logging.warning(f"Could not extract problem ID from subject: {subject}")
+            stats.count("failed")
+            continue
+
+        problem_id = int(match.group(1))
+        # Skip first line of the problem statement
+        cleaned_problem_text = problem_text.split("\n", 1)[1].strip()
+        yield uid, problem_id, cleaned_problem_text, problem_text
 
-    with Session() as session:
-        for subject, problem_text in get_problems():
-            match = re.search(r"Problem #(\d+)", subject)
-            if not match:
-                logging.warning(f"Could not extract problem ID from subject: {subject}")
-                continue
 
-            problem_id = int(match.group(1))
-            # Skip first line of the problem statement
-            cleaned_problem_text = problem_text.split("\n", 1)[1].strip()
+def new_problems(
+    session, sync_state=None, retry_uids=(), stats: Optional[IngestionStats] = None
+):
+    """
+    Yield ((uid, problem_id, cleaned_problem_text), problem_text) for emails not in the
+    database yet.
 
-            existing_problem = session.query(
-                exists().where(
-                    func.regexp_replace(Problem.problem, r"\s+", " ", "g")
-                    == func.regexp_replace(
-                        literal(cleaned_problem_text), r"\s+", " ", "g"
-                    )
+    Emails are checked DEDUP_BATCH_SIZE at a time against the unique content_hash index.
+    """
+    seen = set()
+    stats = stats or IngestionStats()
+    parsed = parse_problems(sync_state, retry_uids, stats)
+    while batch := list(islice(parsed, DEDUP_BATCH_SIZE)):
+        with stats.time("dedup"):
+            hashes = [hash_problem_text(cleaned) for _, _, cleaned, _ in batch]
+            existing = set(
+                session.scalars(
+                    select(Problem.content_hash).where(Problem.content_hash.in_(hashes))
                 )
-            ).scalar()
-            if existing_problem:
+            )
+
+        for (uid, problem_id, cleaned_problem_text, problem_text), text_hash in zip(
+            batch, hashes
+        ):
+            # Problems still being classified are not in the database yet
+            if text_hash in existing or text_hash in seen:
                 logging.debug(f"Saw existing problem {problem_id}. Skipping.")
+                stats.count("duplicates")
                 continue
+            seen.add(text_hash)
 
-            result = classify_problem(client, problem_text)
-            result = dict(result)
-            result["external_id"] = problem_id
-            result["problem"] = cleaned_problem_text
-            result["test_cases"] = [dict(v) for v in result["test_cases"]]
-            result["source"] = "Daily Coding Problem"
+            yield (uid, problem_id, cleaned_problem_text), problem_text
 
-            session.add(Problem(**result))
-            session.commit()
 
-            logging.info(
-                f"Inserted problem {problem_id}. {result['title']} into the database."
-            )
-            problems_added += 1
+def insert_problems(session, rows) -> int:
+    """Insert problems in one statement, skipping stored statements, return how many were new."""
+    statement = (
+        insert(Problem)
+        .values([dict(values, **derived_columns(values)) for values in rows])
+        .on_conflict_do_nothing(index_elements=[Problem.content_hash])
+    )
+    return session.execute(statement).rowcount
+
+
+def update_problems(session, where, values) -> int:
+    """
+    Set `values` on the problems matching `where`, return how many were updated.
+
+    The rendered JSON and content hash depend on the whole row, so the matching rows
+    are read under a row lock, changed here and written back with both recomputed.
+    """
+    table = Problem.__table__
+    rows = session.execute(
+        select(*(table.c[name] for name in PROBLEM_FIELDS)).where(where).with_for_update()
+    ).mappings()
+    params = []
+    for row in rows:
+        changed = dict(row, **values)
+        changed.update(derived_columns(changed))
+        params.append({f"_{name}": changed[name] for name in ("id", *values, *DERIVED_COLUMNS)})
+
+    if params:
+        session.execute(
+            update(table)
+            .where(table.c.id == bindparam("_id"))
+            .values({name: bindparam(f"_{name}") for name in (*values, *DERIVED_COLUMNS)}),
+            params,
+        )
+    return len(params)
+
+
+class ProblemWriter:
+    """
+    Buffer classified problems and write them with one multi-row INSERT and commit per batch.
+
+    A batch is flushed once it holds batch_size rows, or when a row arrives more than
+    max_delay seconds after the first one of the batch. A batch that fails is split in
+    half until the offending rows are isolated, their keys are kept in `failed_keys`.
+    """
+
+    def __init__(
+        self,
+        session,
+        batch_size: int = WRITE_BATCH_SIZE,
+        max_delay: float = WRITE_BATCH_SECONDS,
+        stats: Optional[IngestionStats] = None,
+    ):
+        self.session = session
+        self.stats = stats or IngestionStats()
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed_keys = {}
+        self._rows = []
+        self._started = None
+
+    @property
+    def failed(self) -> int:
+        return len(self.failed_keys)
+
+    def add(self, values: dict, key=None) -> None:
+        """Queue a row, `key` identifies it in `failed_keys` if it cannot be inserted."""
+        if not self._rows:
+            self._started = time.monotonic()
+        self._rows.append((key, values))
+        if (
+            len(self._rows) >= self.batch_size
+            or time.monotonic() - self._started >= self.max_delay
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+
+        start = time.monotonic()
+        inserted = self._write(rows)
+        elapsed = time.monotonic() - start
+        self.stats.record("commit", elapsed)
+        logging.info(
+            f"Wrote batch of {len(rows)} problems ({inserted} new) in {elapsed:.3f}s, "
+            f"{len(rows) / elapsed if elapsed else float('inf'):.1f} rows/s."
+        )
 
-    logging.info(f"Added {problems_added} new problems.")
+    def _write(self, rows) -> int:
+        try:
+            inserted = insert_problems(self.session, [values for _, values in rows])
+            if inserted:
+                bump_catalog_version(self.session)
+            self.session.commit()
+        except DBAPIError as e:
+            self.session.rollback()
+            if len(rows) == 1:
+                key, values = rows[0]
+                logging.error(f"Could not insert problem {values.get('external_id')}: {e.orig}")
+                self.failed_keys[key] = e.orig
+                return 0
+            middle = len(rows) // 2
+            return self._write(rows[:middle]) + self._write(rows[middle:])
+
+        self.inserted += inserted
+        self.duplicates += len(rows) - inserted
+        return inserted
+
+
+def problem_values(problem_id: int, cleaned_problem_text: str, result: ProblemSchema) -> dict:
+    """Column values of a classified problem, JSON serializable so they can pass between tasks."""
+    values = result.model_dump(mode="json")
+    values["external_id"] = problem_id
+    values["problem"] = cleaned_problem_text
+    values["source"] = "Daily Coding Problem"
+    return values
+
+
+def persist_classified(
+    session, results, sync_state: dict, retry_uids, stats: Optional[IngestionStats] = None
+) -> int:
+    """
+    Write (uid, values, error) results in batches and finish the sync run, return the
+    number of new problems. Shared by get_new_problems and the persist_problems task.
+    """
+    failures = {}
+    stats = stats or IngestionStats()
+    writer = ProblemWriter(session, stats=stats)
+    for uid, values, error in results:
+        if error is not None:
+            logging.error(f"Could not classify IMAP message {uid}: {error}")
+            failures[uid] = error
+            continue
+        stats.count("classified")
+        writer.add(values, key=uid)
+    writer.flush()
+    failures.update(writer.failed_keys)
+    finish_sync(session, sync_state, retry_uids, failures)
+    stats.count("inserted", writer.inserted)
+    stats.count("duplicates", writer.duplicates)
+    stats.count("failed", len(failures))
+
+    logging.info(f"Added {writer.inserted} new problems.")
+    return writer.inserted
+
+
+@app.task()
+def get_new_problems(force_refresh: bool = False):
+    """Run the whole ingestion in this process, fetch_new_problems spreads it over workers."""
+    client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+    cache = classification_cache()
+    stats = IngestionStats()
+
+    with Session() as session:
+        sync_state = load_sync_state(session)
+        retry_uids = load_retry_uids(session, sync_state)
+        classified = classify_in_order(
+            client,
+            new_problems(session, sync_state, retry_uids, stats),
+            cache=cache,
+            force_refresh=force_refresh,
+            stats=stats,
+        )
+        results = (
+            (uid, None, error)
+            if error is not None
+            else (uid, problem_values(problem_id, cleaned_problem_text, result), None)
+            for (uid, problem_id, cleaned_problem_text), result, error in classified
+        )
+        persist_classified(session, results, sync_state, retry_uids, stats)
+
+    if cache is not None:
+        logging.info(
+            f"Classification cache: {cache.hits} hits, {cache.misses} misses."
+        )
+    stats.report()
+
+
+# Distributed pipeline: fetch_new_problems fans out one classify_message task per new
+# email, a chord collects their results into a single batched persist_problems call.
+
+
+@functools.lru_cache(maxsize=None)
+def worker_openai_client() -> OpenAI:
+    return OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+
+
+@functools.lru_cache(maxsize=None)
+def worker_rate_limiter():
+    """The OPENAI_RPM budget shared by all workers through the Redis broker, if there is one."""
+    if CELERY_BROKER_URL.startswith(("redis://", "rediss://")):
+        return RedisRateLimiter(redis.Redis.from_url(CELERY_BROKER_URL), OPENAI_RPM)
+    return RateLimiter(OPENAI_RPM)
+
+
+@functools.lru_cache(maxsize=None)
+def worker_classification_cache() -> Optional[DiskCache]:
+    return classification_cache()
+
+
+@app.task()
+def fetch_new_problems(force_refresh: bool = False):
+    stats = IngestionStats()
+    with Session() as session:
+        sync_state = load_sync_state(session)
+        retry_uids = load_retry_uids(session, sync_state)
+        messages = list(new_problems(session, sync_state, retry_uids, stats))
+        if not messages:
+            finish_sync(session, sync_state, retry_uids, {})
+            logging.info("No new problems.")
+            stats.report()
+            return None
+
+    logging.info(f"Classifying {len(messages)} new problems.")
+    header = [
+        classify_message.s(uid, problem_id, cleaned_problem_text, problem_text, force_refresh)
+        for (uid, problem_id, cleaned_problem_text), problem_text in messages
+    ]
+    # The run is reported by persist_problems, with these fetch stages included
+    return chord(header)(persist_problems.s(sync_state, retry_uids, stats.snapshot()))
+
+
+@app.task(bind=True, max_retries=OPENAI_MAX_RETRIES)
+def classify_message(
+    self,
+    uid: int,
+    problem_id: int,
+    cleaned_problem_text: str,
+    problem_text: str,
+    force_refresh: bool = False,
+):
+    """
+    Classify one email into (uid, values, error, seconds). Rate limit errors are retried by
+    Celery, a final failure is returned as the error so that one bad email does not fail
+    the chord. `seconds` is the time this attempt took, for the run's classify stage.
+    """
+    started = time.perf_counter()
+    try:
+        result = classify_cached(
+            worker_openai_client(),
+            problem_text,
+            worker_rate_limiter(),
+            worker_classification_cache(),
+            force_refresh,
+            max_retries=0,
+        )
+    except RETRYABLE_ERRORS as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=retry_delay(e, self.request.retries))
+        return uid, None, str(e), time.perf_counter() - started
+    except Exception as e:
+        return uid, None, str(e), time.perf_counter() - started
+
+    values = problem_values(problem_id, cleaned_problem_text, result)
+    return uid, values, None, time.perf_counter() - started
+
+
+@app.task()
+def persist_problems(results, sync_state: dict, retry_uids, fetch_stats=None) -> int:
+    stats = IngestionStats()
+    if fetch_stats is not None:
+        stats.merge(fetch_stats)
+    for *_, seconds in results:
+        stats.record("classify", seconds)
+    with Session() as session:
+        inserted = persist_classified(
+            session,
+            [(uid, values, error) for uid, values, error, _ in results],
+            sync_state,
+            retry_uids,
+            stats,
+        )
+    stats.report()
+    return inserted
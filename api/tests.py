@@ -1,4 +1,10 @@
+import json
 import os
+import threading
+from email import message_from_bytes
+from email.message import EmailMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 from sanic_testing import TestManager
 from sqlalchemy import create_engine
@@ -192,3 +198,1504 @@ async def test_sitemap():
     content = response.text
     assert "<urlset" in content
     assert "</urlset>" in content
+
+
+@pytest.mark.asyncio
+async def test_facets_array_counts():
+    """
+    Test GET /api/facets counts JSONB array values across matching rows.
+    """
+    request, response = await sanic_app.asgi_client.get("/api/facets")
+    assert response.status_code == 200
+    data = response.json
+
+    assert data["data_structures"] == [
+        {"value": "Array", "count": 2},
+        {"value": "DP", "count": 1},
+    ]
+    assert data["algorithms"] == [{"value": "Hash Table", "count": 1}]
+    assert data["tags"] == []
+
+
+def test_facets_ties_sorted_by_value():
+    """
+    Test array facet values with the same count come out in value order, whatever the
+    order of the rows they were collected from.
+    """
+    from api.catalog import FacetRow
+    from api.facets import collect_facets
+
+    rows = [
+        FacetRow("tags", "graphs", 1),
+        FacetRow("tags", "arrays", 2),
+        FacetRow("tags", "dp", 1),
+        FacetRow("tags", "bfs", 1),
+    ]
+    expected = ["arrays", "bfs", "dp", "graphs"]
+    assert [item["value"] for item in collect_facets(rows)["tags"]] == expected
+    assert [item["value"] for item in collect_facets(rows[::-1])["tags"]] == expected
+
+
+@pytest.mark.asyncio
+async def test_result_cache_invalidated_by_catalog_version():
+    """
+    Test repeated GET /api/problems is served from cache until the catalog version changes.
+    """
+    from api.tasks import Session, bump_catalog_version
+
+    url = "/api/problems?company=Google&limit=5"
+    request, response = await sanic_app.asgi_client.get(url)
+    assert response.status_code == 200
+    request, response = await sanic_app.asgi_client.get(url)
+    assert response.headers["x-cache"] == "HIT"
+    assert response.json["total"] == 1
+
+    with Session() as session:
+        bump_catalog_version(session)
+        session.commit()
+
+    request, response = await sanic_app.asgi_client.get(url)
+    assert response.headers["x-cache"] == "MISS"
+    assert response.json["total"] == 1
+
+    request, response = await sanic_app.asgi_client.get("/api/cache/stats")
+    assert response.json["result_cache"]["hits"] >= 1
+    assert response.json["result_cache"]["bytes"] > 0
+
+
+@pytest.mark.asyncio
+async def test_list_problems_limit_bounds():
+    """
+    Test page sizes outside 1..MAX_PAGE_SIZE are rejected instead of cached.
+    """
+    max_page_size = sanic_app.config.MAX_PAGE_SIZE
+    for limit in (0, max_page_size + 1, "ten"):
+        request, response = await sanic_app.asgi_client.get(f"/api/problems?limit={limit}")
+        assert response.status_code == 400
+
+    request, response = await sanic_app.asgi_client.get(f"/api/problems?limit={max_page_size}")
+    assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_list_problems_count_modes():
+    """
+    Test total is exact on every kind of page, estimated on request, or left out.
+    """
+    sanic_app.ctx.result_cache.clear()
+    for url in (
+        "/api/problems?limit=1",
+        "/api/problems?limit=1&sort_order=desc",
+        "/api/problems?offset=10",
+        "/api/problems?fields=id,title",
+    ):
+        request, response = await sanic_app.asgi_client.get(url)
+        assert response.json["total"] == 2
+    assert set(response.json["problems"][0]) == {"id", "title"}
+
+    # The total from the page query also counts the rows before a cursor
+    sanic_app.ctx.result_cache.clear()
+    request, response = await sanic_app.asgi_client.get("/api/problems?limit=1")
+    cursor = response.json["next_cursor"]
+    sanic_app.ctx.result_cache.clear()
+    request, response = await sanic_app.asgi_client.get(f"/api/problems?limit=1&after={cursor}")
+    assert response.json["total"] == 2
+
+    request, response = await sanic_app.asgi_client.get("/api/problems?count=none")
+    assert response.json["total"] is None
+    assert len(response.json["problems"]) == 2
+
+    for url in ("/api/problems?count=estimate", "/api/problems?count=estimate&company=Google"):
+        request, response = await sanic_app.asgi_client.get(url)
+        assert response.status_code == 200
+        assert isinstance(response.json["total"], int)
+
+    request, response = await sanic_app.asgi_client.get("/api/problems?count=maybe")
+    assert response.status_code == 400
+
+
+def test_lru_cache_byte_bound():
+    """
+    Test the response cache evicts by total body size and skips oversized bodies.
+    """
+    from api.cache import LRUCache
+
+    cache = LRUCache(maxsize=10, max_bytes=10)
+    cache.set("a", b"xxxx")
+    cache.set("b", b"xxxx")
+    cache.get("a")
+    cache.set("c", b"xxxx")
+    cache.set("huge", b"x" * 11)
+
+    assert [cache.get(key) is not None for key in "abc"] == [True, False, True]
+    assert cache.get("huge") is None
+    assert cache.stats()["bytes"] == 8
+
+
+def test_pool_limits_fit_connection_budget():
+    """
+    Test the per-worker pools together never exceed the Postgres connection budget.
+    """
+    from types import SimpleNamespace
+
+    from api.app import background_connections, pool_limits
+
+    for catalog_index in (False, True):
+        background = background_connections(SimpleNamespace(CATALOG_INDEX=catalog_index))
+        for workers in (1, 2, 4, 8, 30):
+            pool_size, max_overflow = pool_limits(workers, 100, 10, background)
+            assert pool_size >= 1
+            # Request pools at full overflow plus the LISTEN and catalog connections
+            assert workers * (pool_size + max_overflow + background) <= 90
+    assert pool_limits(4, max_connections=100, reserved=10) == (16, 6)
+    assert pool_limits(4, max_connections=100, reserved=10, background=2) == (15, 5)
+
+
+def test_worker_recycled_after_max_requests(monkeypatch):
+    """
+    Test a worker asks for a zero-downtime restart exactly once it reaches its limit.
+    """
+    from types import SimpleNamespace
+    from api.app import maybe_recycle_worker
+
+    restarts = []
+    fake_app = SimpleNamespace(
+        ctx=SimpleNamespace(requests_served=0, recycle_after=3),
+        multiplexer=SimpleNamespace(restart=lambda **kwargs: restarts.append(kwargs)),
+    )
+    for _ in range(5):
+        maybe_recycle_worker(fake_app)
+
+    assert restarts == [{"zero_downtime": True}]
+
+
+@pytest.mark.asyncio
+async def test_session_opened_on_first_use(monkeypatch):
+    """
+    Test requests that never query the database don't open a session.
+    """
+    import api.app
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+    opened = []
+
+    def counting_session(*args, **kwargs):
+        opened.append(args)
+        return AsyncSession(*args, **kwargs)
+
+    monkeypatch.setattr(api.app, "AsyncSession", counting_session)
+
+    request, response = await sanic_app.asgi_client.get("/api/cache/stats")
+    assert response.status_code == 200
+    assert opened == []
+
+    request, response = await sanic_app.asgi_client.get("/api/facets")
+    assert response.status_code == 200
+    assert len(opened) == 1
+
+
+@pytest.mark.asyncio
+async def test_reads_fall_back_to_primary_when_replica_down(monkeypatch):
+    """
+    Test GET endpoints read from a healthy replica and from the primary while it is down.
+    The "replica" is the test database itself, or a port nothing listens on.
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from api.app import check_replica, database_url
+
+    monkeypatch.setattr(sanic_app.config, "DB_REPLICA_CHECK_INTERVAL", 3600)
+
+    monkeypatch.setattr(sanic_app.config, "DB_REPLICA_HOST", sanic_app.config.DB_HOST)
+    request, response = await sanic_app.asgi_client.get("/api/facets")
+    assert response.status_code == 200
+    assert request.ctx.session.bind is sanic_app.ctx.replica_engine
+
+    monkeypatch.setattr(sanic_app.config, "DB_REPLICA_HOST", "127.0.0.1:1")
+    request, response = await sanic_app.asgi_client.get("/api/facets")
+    assert response.status_code == 200
+    assert not sanic_app.ctx.replica_healthy
+    assert request.ctx.session.bind is sanic_app.ctx.engine
+
+    # Once the replica answers again, reads move back to it
+    sanic_app.ctx.replica_engine = create_async_engine(database_url(sanic_app.config.DB_HOST))
+    assert await check_replica(sanic_app)
+    await sanic_app.ctx.replica_engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_query_error_keeps_replica_in_use():
+    """
+    Test a failed query on the replica leaves it in use, a lost connection does not.
+    """
+    from types import SimpleNamespace
+
+    from sqlalchemy import text
+    from sqlalchemy.exc import DBAPIError
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    from api.app import database_url, exception_handler
+
+    replica = create_async_engine(database_url(sanic_app.config.DB_HOST))
+    fake_app = SimpleNamespace(ctx=SimpleNamespace(replica_engine=replica, replica_healthy=True))
+    request = SimpleNamespace(
+        app=fake_app, ctx=SimpleNamespace(session=SimpleNamespace(bind=replica))
+    )
+    try:
+        with pytest.raises(DBAPIError) as query_error:
+            async with replica.connect() as conn:
+                await conn.execute(text("SELECT 1 / 0"))
+        response = await exception_handler(request, query_error.value)
+        assert response.status == 500
+        assert fake_app.ctx.replica_healthy
+
+        with pytest.raises(DBAPIError) as lost_connection:
+            async with replica.connect() as conn:
+                await conn.execute(text("SELECT pg_terminate_backend(pg_backend_pid())"))
+        await exception_handler(request, lost_connection.value)
+        assert not fake_app.ctx.replica_healthy
+    finally:
+        await replica.dispose()
+
+
+def test_lru_cache_ttl():
+    """
+    Test entries expire after the TTL and invalidate() drops a single entry.
+    """
+    import time
+    from api.cache import LRUCache
+
+    cache = LRUCache(maxsize=10, ttl=0.05)
+    cache.set(1, b"one")
+    cache.set(2, b"two")
+    cache.invalidate(2)
+    assert cache.get(1) == b"one"
+    assert cache.get(2) is None
+
+    time.sleep(0.06)
+    assert cache.get(1) is None
+    assert cache.stats()["bytes"] == 0
+    assert cache.stats()["invalidations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_problem_cache_invalidated_by_notify():
+    """
+    Test a write to a problem row reaches the worker's listener and drops only that record.
+    """
+    import asyncio
+    from types import SimpleNamespace
+    from sqlalchemy import update
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from api.app import database_url, listen_for_changes
+    from api.cache import LRUCache
+
+    # Make sure the trigger exists
+    request, response = await sanic_app.asgi_client.get("/api/problems/1")
+    assert response.status_code == 200
+
+    cache = LRUCache(maxsize=10)
+    engine = create_async_engine(database_url(sanic_app.config.DB_HOST))
+    fake_app = SimpleNamespace(
+        ctx=SimpleNamespace(background_engine=engine, problem_cache=cache, catalog=None)
+    )
+    cache.set("connected", b"")
+    listener = asyncio.create_task(listen_for_changes(fake_app))
+    try:
+        # The cache is cleared once the listener is connected
+        for _ in range(50):
+            if not len(cache):
+                break
+            await asyncio.sleep(0.1)
+        cache.set(1, b"stale")
+        cache.set(2, b"fresh")
+
+        async with engine.begin() as conn:
+            await conn.execute(
+                update(Problem).where(Problem.id == 1).values(title=Problem.title)
+            )
+        for _ in range(50):
+            if cache.invalidations:
+                break
+            await asyncio.sleep(0.1)
+
+        assert cache.get(1) is None
+        assert cache.get(2) == b"fresh"
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+        await engine.dispose()
+
+
+def test_catalog_index_pages_and_refresh():
+    """
+    Test bitset pages, cursors and incremental refresh against plain sorted lists.
+    """
+    import random
+    from types import SimpleNamespace
+    from api.catalog import CatalogIndex
+
+    rng = random.Random(3)
+    rows = [
+        SimpleNamespace(
+            id=problem_id,
+            company=rng.choice(["Google", "Uber", None]),
+            difficulty=rng.choice(["Easy", "Hard"]),
+            data_structures=rng.sample(["Array", "Tree", "Graph"], rng.randint(0, 2)),
+            algorithms=[],
+            tags=[],
+        )
+        for problem_id in rng.sample(range(1, 20000), 3000)
+    ]
+    index = CatalogIndex()
+    index.apply_rows(rows)
+
+    google = sorted(row.id for row in rows if row.company == "Google")
+    bits = index.bitsets["company"]["Google"]
+    assert bits.bit_count() == len(google)
+    assert index.page(bits, 20, offset=100) == google[100:120]
+    assert index.page(bits, 20, offset=5, descending=True) == google[::-1][5:25]
+    assert index.page(index.after(bits, google[10]), 3) == google[11:14]
+    assert index.page(index.before(bits, google[10]), 3, descending=True) == google[9:6:-1]
+    assert index.page(bits, 20, offset=len(google)) == []
+
+    # A moved row leaves its old value, a deleted row leaves everything
+    moved, deleted = rows[0], rows[1]
+    moved.company = "Stripe"
+    index.apply_rows([moved], changed_ids={moved.id, deleted.id})
+    assert index.bitsets["company"]["Stripe"] == 1 << moved.id
+    assert len(index) == len(rows) - 1
+    assert not any(
+        value_bits >> deleted.id & 1
+        for values in index.bitsets.values()
+        for value_bits in values.values()
+    )
+
+
+@pytest.mark.asyncio
+async def test_catalog_index_matches_sql(monkeypatch):
+    """
+    Test listings and facets served from the in-memory catalog equal the SQL results.
+    """
+    urls = [
+        "/api/facets",
+        "/api/facets?company=Google",
+        "/api/facets?data_structure=Array&data_structure=DP&match=any",
+        "/api/problems",
+        "/api/problems?sort_order=desc",
+        "/api/problems?limit=1&offset=1",
+        "/api/problems?difficulty=Easy&fields=summary",
+        "/api/problems?data_structure=Array&data_structure=DP",
+        "/api/problems?company=Nobody",
+    ]
+
+    async def get(url):
+        sanic_app.ctx.result_cache.clear()
+        request, response = await sanic_app.asgi_client.get(url)
+        assert response.status_code == 200
+        return response.json
+
+    async def responses():
+        bodies = [await get(url) for url in urls]
+        # Follow the cursors of one-item pages both ways
+        first = await get("/api/problems?limit=1")
+        second = await get(f"/api/problems?limit=1&after={first['next_cursor']}")
+        back = await get(f"/api/problems?limit=1&before={second['prev_cursor']}")
+        return bodies + [second, back]
+
+    monkeypatch.setattr(sanic_app.config, "CATALOG_INDEX", False)
+    expected = await responses()
+    monkeypatch.setattr(sanic_app.config, "CATALOG_INDEX", True)
+    assert await responses() == expected
+    assert sanic_app.ctx.catalog is not None
+    sanic_app.ctx.result_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_list_problems_cursor_pagination():
+    """
+    Test GET /api/problems walks pages with next/prev cursors in both directions.
+    """
+    request, response = await sanic_app.asgi_client.get("/api/problems?limit=1")
+    first = response.json
+    assert [p["id"] for p in first["problems"]] == [1]
+    assert first["prev_cursor"] is None
+    assert first["next_cursor"]
+
+    request, response = await sanic_app.asgi_client.get(
+        f"/api/problems?limit=1&after={first['next_cursor']}"
+    )
+    second = response.json
+    assert [p["id"] for p in second["problems"]] == [2]
+    assert second["next_cursor"] is None
+    assert second["total"] == 2
+
+    request, response = await sanic_app.asgi_client.get(
+        f"/api/problems?limit=1&before={second['prev_cursor']}"
+    )
+    assert [p["id"] for p in response.json["problems"]] == [1]
+    assert response.json["prev_cursor"] is None
+
+    request, response = await sanic_app.asgi_client.get("/api/problems?after=bogus")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_list_problems_fields():
+    """
+    Test GET /api/problems?fields=... returns only the requested columns.
+    """
+    request, response = await sanic_app.asgi_client.get("/api/problems?fields=summary")
+    assert response.status_code == 200
+    problem = response.json["problems"][0]
+    assert problem["title"] == "Two Sum"
+    assert "solution" not in problem
+    assert "code_solution" not in problem
+
+    request, response = await sanic_app.asgi_client.get(
+        "/api/problems?fields=title,difficulty"
+    )
+    assert response.json["problems"][0] == {
+        "id": 1,
+        "title": "Two Sum",
+        "difficulty": "Easy",
+    }
+
+    request, response = await sanic_app.asgi_client.get("/api/problems?fields=secret")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_list_problems_full_text_search():
+    """
+    Test GET /api/problems?search=... matches statements and partial words.
+    """
+    request, response = await sanic_app.asgi_client.get("/api/problems?search=steps")
+    assert response.status_code == 200
+    assert [p["title"] for p in response.json["problems"]] == ["Climbing Stairs"]
+
+    request, response = await sanic_app.asgi_client.get("/api/problems?search=clim")
+    assert [p["title"] for p in response.json["problems"]] == ["Climbing Stairs"]
+
+    request, response = await sanic_app.asgi_client.get("/api/problems?search=array")
+    assert response.json["total"] == 1
+    assert response.json["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_list_problems_multi_value_filters():
+    """
+    Test repeated array filters with match=all (default) and match=any.
+    """
+    url = "/api/problems?data_structure=Array&data_structure=DP"
+    request, response = await sanic_app.asgi_client.get(url)
+    assert response.status_code == 200
+    assert [p["title"] for p in response.json["problems"]] == ["Climbing Stairs"]
+
+    request, response = await sanic_app.asgi_client.get(url + "&match=any")
+    assert response.json["total"] == 2
+
+    request, response = await sanic_app.asgi_client.get(
+        "/api/facets?algorithm=Hash Table&algorithm=Greedy&match=any"
+    )
+    assert response.json["data_structures"] == [
+        {"value": "Array", "count": 1},
+        {"value": "DP", "count": 1},
+    ]
+
+    request, response = await sanic_app.asgi_client.get("/api/problems?match=some")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_sitemap_not_modified():
+    """
+    Test GET /sitemap.xml honours If-None-Match and serves repeats from cache.
+    """
+    request, response = await sanic_app.asgi_client.get("/sitemap.xml")
+    etag = response.headers["etag"]
+    assert "/problems/2</loc>" in response.text
+
+    request, response = await sanic_app.asgi_client.get(
+        "/sitemap.xml", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    request, response = await sanic_app.asgi_client.get("/sitemap.xml")
+    assert response.status_code == 200
+    assert response.headers["etag"] == etag
+    assert response.headers.get("content-type") == "application/xml"
+    assert "</urlset>" in response.text
+
+
+@pytest.mark.asyncio
+async def test_sitemap_index_shards(monkeypatch):
+    """
+    Test a catalog over the URL limit is served as a sitemap index with shards.
+    """
+    import api.views
+
+    monkeypatch.setattr(api.views, "SITEMAP_URL_LIMIT", 3)
+    sanic_app.ctx.sitemap_cache.clear()
+    try:
+        request, response = await sanic_app.asgi_client.get("/sitemap.xml")
+        assert "<sitemapindex" in response.text
+        assert "/sitemap-2.xml</loc>" in response.text
+
+        request, response = await sanic_app.asgi_client.get("/sitemap-1.xml")
+        assert "/about</loc>" in response.text
+        assert "/problems/1</loc>" in response.text
+        assert "/problems/2</loc>" not in response.text
+
+        request, response = await sanic_app.asgi_client.get("/sitemap-2.xml")
+        assert "/problems/2</loc>" in response.text
+        assert "/about</loc>" not in response.text
+
+        request, response = await sanic_app.asgi_client.get("/sitemap-3.xml")
+        assert response.status_code == 404
+    finally:
+        sanic_app.ctx.sitemap_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_conditional_get():
+    """
+    Test API endpoints send ETag/Cache-Control and answer If-None-Match with 304.
+    """
+    for url in ("/api/problems/1", "/api/problems?company=Google", "/api/facets"):
+        request, response = await sanic_app.asgi_client.get(url)
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        assert "max-age" in response.headers["cache-control"]
+
+        request, response = await sanic_app.asgi_client.get(
+            url, headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+    request, response = await sanic_app.asgi_client.get(
+        "/api/problems/1", headers={"If-None-Match": 'W/"stale"'}
+    )
+    assert response.status_code == 200
+
+    # A matching validator never turns a missing problem into a 304
+    request, response = await sanic_app.asgi_client.get(
+        "/api/problems/999", headers={"If-None-Match": "*"}
+    )
+    assert response.status_code == 404
+    assert "cache-control" not in response.headers
+
+
+def test_negotiate_accept_encoding():
+    """
+    Test the coding is picked by q-value, with "*" and q=0 honoured.
+    """
+    from api.compression import negotiate
+
+    encodings = ("br", "gzip")
+    assert negotiate("gzip, deflate, br", encodings) == "br"
+    assert negotiate("br;q=0.5, gzip", encodings) == "gzip"
+    assert negotiate("gzip;q=0, *;q=0.1", encodings) == "br"
+    assert negotiate("deflate", encodings) is None
+    assert negotiate("identity", encodings) is None
+    assert negotiate("", encodings) is None
+    assert negotiate("br", ("gzip",)) is None
+
+
+@pytest.mark.asyncio
+async def test_compressed_responses(monkeypatch):
+    """
+    Test large bodies are gzipped when accepted, cached by ETag, and left alone otherwise.
+    """
+    import gzip
+
+    monkeypatch.setitem(sanic_app.config, "COMPRESSION_MIN_BYTES", 64)
+    monkeypatch.setattr("api.compression.brotli", None)
+    cache = sanic_app.ctx.compressed_cache
+    cache.clear()
+    sanic_app.ctx.sitemap_cache.clear()
+    try:
+        request, response = await sanic_app.asgi_client.get(
+            "/api/problems/1", headers={"Accept-Encoding": "identity"}
+        )
+        body = response.content
+        strong_etag = response.headers["etag"]
+        assert "content-encoding" not in response.headers
+        assert response.headers["vary"] == "Accept-Encoding"
+
+        hits = cache.stats()["hits"]
+        for expected_hits in (hits, hits + 1):
+            request, response = await sanic_app.asgi_client.get(
+                "/api/problems/1", headers={"Accept-Encoding": "br;q=1, gzip;q=0.8"}
+            )
+            assert response.headers["content-encoding"] == "gzip"
+            assert response.headers["etag"] == f"W/{strong_etag}"
+            assert response.content == body
+            assert cache.stats()["hits"] == expected_hits
+
+        request, response = await sanic_app.asgi_client.get(
+            "/api/problems/1",
+            headers={"Accept-Encoding": "gzip", "If-None-Match": f"W/{strong_etag}"},
+        )
+        assert response.status_code == 304
+        assert response.headers["etag"] == f"W/{strong_etag}"
+        assert response.headers["vary"] == "Accept-Encoding"
+        request, response = await sanic_app.asgi_client.get(
+            "/api/problems/1", headers={"If-None-Match": strong_etag}
+        )
+        assert response.status_code == 304
+        assert response.headers["etag"] == strong_etag
+        assert response.headers["vary"] == "Accept-Encoding"
+
+        # A cache miss is streamed uncompressed, the cached sitemap is compressed
+        request, response = await sanic_app.asgi_client.get(
+            "/sitemap.xml", headers={"Accept-Encoding": "gzip"}
+        )
+        assert "content-encoding" not in response.headers
+        assert response.headers["vary"] == "Accept-Encoding"
+        request, response = await sanic_app.asgi_client.get(
+            "/sitemap.xml", headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.headers["content-encoding"] == "gzip"
+        assert "</urlset>" in response.text
+        assert gzip.decompress(cache.get((response.headers["etag"][2:], "gzip"))).endswith(
+            b"</urlset>"
+        )
+
+        monkeypatch.setitem(sanic_app.config, "COMPRESSION_MIN_BYTES", 1024 * 1024)
+        request, response = await sanic_app.asgi_client.get(
+            "/api/problems/1", headers={"Accept-Encoding": "gzip"}
+        )
+        assert "content-encoding" not in response.headers
+        assert response.headers["etag"] == strong_etag
+        assert response.headers["vary"] == "Accept-Encoding"
+    finally:
+        cache.clear()
+        sanic_app.ctx.sitemap_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(monkeypatch):
+    """
+    Test /metrics reports request latency and per-request SQL in Prometheus format.
+    """
+    from api.metrics import REQUEST_QUERIES
+
+    route = "/api/problems/<problem_id:int>"
+    before = sum(REQUEST_QUERIES.values.get((route,), [[0], 0])[0])
+    sanic_app.ctx.problem_cache.clear()
+    request, response = await sanic_app.asgi_client.get("/api/problems/2")
+    assert response.status_code == 200
+
+    monkeypatch.setitem(sanic_app.config, "METRICS_TOKEN", "secret")
+    request, response = await sanic_app.asgi_client.get(
+        "/metrics", headers={"Authorization": "Bearer secret"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert "# TYPE http_request_duration_seconds histogram" in lines
+    assert f'http_requests_total{{route="{route}",method="GET",status="200"}}' in response.text
+    assert f'http_request_duration_seconds_bucket{{route="{route}",method="GET",le="+Inf"}}' in (
+        response.text
+    )
+    assert 'db_pool_checkout_seconds_count{pool="primary"}' in response.text
+    assert 'cache_entries{cache="problem_cache"}' in response.text
+    # The record was read with one statement
+    assert sum(REQUEST_QUERIES.values[(route,)][0]) == before + 1
+    assert REQUEST_QUERIES.values[(route,)][0][1] >= 1
+
+    request, response = await sanic_app.asgi_client.get("/metrics")
+    assert response.status_code == 403
+    request, response = await sanic_app.asgi_client.get(
+        "/metrics", headers={"Authorization": "Bearer wrong"}
+    )
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_metrics_disabled_without_token(monkeypatch):
+    """
+    Test /metrics rejects every request while no METRICS_TOKEN is configured.
+    """
+    monkeypatch.setitem(sanic_app.config, "METRICS_TOKEN", "")
+    request, response = await sanic_app.asgi_client.get("/metrics")
+    assert response.status_code == 403
+    request, response = await sanic_app.asgi_client.get(
+        "/metrics", headers={"Authorization": "Bearer "}
+    )
+    assert response.status_code == 403
+
+
+def test_metrics_snapshots_of_workers(tmp_path):
+    """
+    Test snapshots of several workers are summed, and an exited worker keeps its counters only.
+    """
+    from api.metrics import Counter, Gauge, Histogram, Registry, collect_snapshots, write_json
+
+    registry = Registry()
+    requests = Counter("requests_total", "Requests.", ("route",), registry=registry)
+    in_flight = Gauge("in_flight", "Requests being handled.", registry=registry)
+    latency = Histogram("latency_seconds", "Latency.", registry=registry, buckets=(0.1, 1))
+    requests.inc(route="/a")
+    in_flight.inc()
+    latency.observe(0.05)
+
+    exited = {
+        "requests_total": [[["/a"], 2], [['say "hi"'], 1]],
+        "in_flight": [[[], 5]],
+        "latency_seconds": [[[], [[0, 1, 1], 3.5]]],
+    }
+    # A pid above any pid_max belongs to no process
+    write_json(str(tmp_path / "worker-999999999.json"), exited)
+
+    for _ in range(2):
+        text = registry.render(collect_snapshots(str(tmp_path), registry))
+        assert 'requests_total{route="/a"} 3' in text
+        assert 'requests_total{route="say \\"hi\\""} 1' in text
+        assert "in_flight 1" in text
+        assert 'latency_seconds_bucket{le="0.1"} 1' in text
+        assert 'latency_seconds_bucket{le="1"} 2' in text
+        assert 'latency_seconds_bucket{le="+Inf"} 3' in text
+        assert "latency_seconds_sum 3.55" in text
+        assert "latency_seconds_count 3" in text
+    assert not (tmp_path / "worker-999999999.json").exists()
+    assert (tmp_path / "retired.json").exists()
+
+
+@pytest.mark.asyncio
+async def test_get_problem_prerendered_matches_to_dict():
+    """
+    Test GET /api/problems/<problem_id> serves the pre-rendered record in to_dict() shape.
+    """
+    request, response = await sanic_app.asgi_client.get("/api/problems/2")
+    assert response.status_code == 200
+    assert response.json == {
+        "id": 2,
+        "title": "Climbing Stairs",
+        "problem": "You can climb 1 or 2 steps...",
+        "company": "Google",
+        "source": "tests",
+        "difficulty": "Easy",
+        "data_structures": ["Array", "DP"],
+        "algorithms": ["Hash Table"],
+        "tags": [],
+        "time_complexity": None,
+        "space_complexity": None,
+        "passes_allowed": None,
+        "edge_cases": [],
+        "input_types": [],
+        "test_cases": [],
+        "output_types": [],
+        "hints": [],
+        "solution": "def two_sum(nums, target):...",
+        "code_solution": "def two_sum(nums, target):...",
+    }
+
+
+@pytest.fixture
+def fake_openai():
+    """
+    Local OpenAI-compatible server. Chat completions echo the user message as the
+    problem title, the very first request is rejected with a 429.
+    """
+    from api.tasks import ProblemSchema
+
+    example = ProblemSchema.model_config["json_schema_extra"]["example"]
+    calls = []
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with lock:
+                calls.append(request)
+                first = len(calls) == 1
+            if first:
+                body, status = {"error": {"message": "Rate limit"}}, 429
+            else:
+                parsed = dict(example, title=request["messages"][-1]["content"])
+                message = {"role": "assistant", "content": json.dumps(parsed)}
+                body, status = {
+                    "id": "chatcmpl-test",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": request["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+                }, 200
+
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_port}/v1"
+    server.calls = calls
+    yield server
+    server.shutdown()
+
+
+def test_classify_in_order_against_fake_server(fake_openai):
+    """
+    Test concurrent classification retries a 429 and keeps results in input order.
+    """
+    from openai import OpenAI
+    from api.tasks import RateLimiter, classify_in_order
+
+    client = OpenAI(api_key="test", base_url=fake_openai.url, max_retries=0)
+    items = [(n, f"Problem {n}") for n in range(5)]
+    results = list(
+        classify_in_order(client, items, concurrency=3, limiter=RateLimiter(0))
+    )
+
+    assert [key for key, _, _ in results] == [0, 1, 2, 3, 4]
+    assert [error for _, _, error in results] == [None] * 5
+    assert [result.title for _, result, _ in results] == [text for _, text in items]
+    assert len(fake_openai.calls) == 6
+
+
+def test_classification_cache_skips_api_calls(fake_openai, tmp_path):
+    """
+    Test cached classifications are reused without requests, unless forced to refresh.
+    """
+    from openai import OpenAI
+    from api.cache import DiskCache
+    from api.tasks import RateLimiter, classify_in_order
+
+    client = OpenAI(api_key="test", base_url=fake_openai.url, max_retries=0)
+    cache = DiskCache(str(tmp_path), max_bytes=1024 * 1024)
+    items = [(n, f"Problem {n}") for n in range(3)]
+
+    def run(**kwargs):
+        results = classify_in_order(
+            client, items, concurrency=2, limiter=RateLimiter(0), cache=cache, **kwargs
+        )
+        return [result.title for _, result, _ in results]
+
+    assert run() == [text for _, text in items]
+    calls = len(fake_openai.calls)
+    assert run() == [text for _, text in items]
+    assert len(fake_openai.calls) == calls
+    assert cache.hits == 3
+    run(force_refresh=True)
+    assert len(fake_openai.calls) == calls + 3
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    """
+    Test the disk cache stays within its size bound and keeps recently read entries.
+    """
+    from api.cache import DiskCache
+
+    cache = DiskCache(str(tmp_path), max_bytes=400)
+    for n in range(3):
+        cache.set(f"key{n}", "x" * 100)
+        os.utime(tmp_path / f"key{n}.json", (n, n))
+    assert cache.get("key0") == "x" * 100
+    cache.set("key3", "x" * 100)
+
+    assert cache.get("key1") is None
+    assert [cache.get(f"key{n}") for n in (0, 2, 3)] == ["x" * 100] * 3
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 400
+
+
+class FakeIMAP:
+    """In-memory IMAP stand-in for the UID commands used by the ingestion task."""
+
+    def __init__(self, uidvalidity=100):
+        self.uidvalidity = uidvalidity
+        self.messages = {}
+        self.fetched = []
+        self.round_trips = 0
+
+    @staticmethod
+    def structure(message):
+        parts = " ".join(
+            f'("{part.get_content_maintype()}" "{part.get_content_subtype()}" '
+            f'("charset" "utf-8") NIL NIL "{part["Content-Transfer-Encoding"]}" 0 0)'
+            for part in message.get_payload()
+        )
+        return f'({parts} "{message.get_content_subtype()}")'
+
+    def add(self, uid, number, statement):
+        message = EmailMessage()
+        message["Subject"] = f"Daily Coding Problem: Problem #{number} [Easy]"
+        message.set_content(
+            "Good morning! Here's your coding interview problem for today.\n\n"
+            f"This problem was asked by Google.\n\n{statement}\n\n" + "-" * 80 + "\n"
+        )
+        message.add_alternative(f"<p>{statement}</p>", subtype="html")
+        self.messages[uid] = message.as_bytes()
+
+    def login(self, user, password):
+        return "OK", [b"Logged in"]
+
+    def select(self, mailbox):
+        return "OK", [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        return code, [str(self.uidvalidity).encode()]
+
+    def uid(self, command, *args):
+        if command == "SEARCH":
+            low = int(args[0].split()[1].split(":")[0])
+            # Like a real server, "n:*" also matches the highest UID
+            uids = [uid for uid in self.messages if uid >= low or uid == max(self.messages)]
+            return "OK", [" ".join(map(str, sorted(uids))).encode()]
+        if command == "FETCH":
+            self.round_trips += 1
+            uids, spec = [int(uid) for uid in args[0].split(",")], args[1]
+            self.fetched.extend(uids)
+            data = []
+            for seq, uid in enumerate(uids, start=1):
+                message = message_from_bytes(self.messages[uid])
+                if "BODYSTRUCTURE" in spec:
+                    header = f"Subject: {message['Subject']}\r\n\r\n".encode()
+                    meta = f"{seq} (UID {uid} BODYSTRUCTURE {self.structure(message)} "
+                    meta += f"BODY[HEADER.FIELDS (SUBJECT)] {{{len(header)}}}"
+                    data += [(meta.encode(), header), b")"]
+                elif "BODY.PEEK[" in spec:
+                    part = spec.split("[")[1].split("]")[0]
+                    payload = message.get_payload(int(part) - 1).get_payload().encode()
+                    meta = f"{seq} (UID {uid} BODY[{part}] {{{len(payload)}}}"
+                    data += [(meta.encode(), payload), b")"]
+                else:
+                    raw = self.messages[uid]
+                    meta = f"{seq} (UID {uid} RFC822 {{{len(raw)}}}"
+                    data += [(meta.encode(), raw), b")"]
+            return "OK", data
+        raise NotImplementedError(command)
+
+    def close(self):
+        return "OK", []
+
+    def logout(self):
+        return "BYE", []
+
+
+@pytest.fixture
+def fake_imap(monkeypatch):
+    import api.tasks
+
+    imap = FakeIMAP()
+    imap.add(3, 1, "Given a list of numbers, return whether any two sum to k.")
+    imap.add(5, 2, "Given an array of integers, return a new array of products.")
+    imap.add(9, 3, "Given the root to a binary tree, serialize it into a string.")
+    monkeypatch.setattr(api.tasks, "imap_connect", lambda: imap)
+    return imap
+
+
+def test_get_problems_incremental_sync(fake_imap):
+    """
+    Test get_problems only fetches UIDs above the stored position, unless UIDVALIDITY changes.
+    """
+    from api.tasks import get_problems
+
+    sync_state = {"uidvalidity": None, "last_uid": 0}
+    problems = list(get_problems(sync_state))
+    assert [subject for _, subject, _ in problems] == [
+        "Daily Coding Problem: Problem #1 [Easy]",
+        "Daily Coding Problem: Problem #2 [Easy]",
+        "Daily Coding Problem: Problem #3 [Easy]",
+    ]
+    assert problems[0][2].startswith("This problem was asked by Google.")
+    assert sync_state == {"uidvalidity": 100, "last_uid": 9}
+
+    fake_imap.fetched.clear()
+    assert list(get_problems(sync_state)) == []
+    assert fake_imap.fetched == []
+
+    fake_imap.add(12, 4, "Given an array of integers, find the first missing positive.")
+    assert len(list(get_problems(sync_state))) == 1
+    assert set(fake_imap.fetched) == {12}
+    assert sync_state["last_uid"] == 12
+
+    fake_imap.uidvalidity = 200
+    assert len(list(get_problems(sync_state))) == 4
+    assert sync_state == {"uidvalidity": 200, "last_uid": 12}
+
+
+def test_get_problems_batched_partial_fetch(fake_imap, monkeypatch):
+    """
+    Test messages are fetched in UID batches and only their text/plain section is read.
+    """
+    import api.tasks
+
+    monkeypatch.setattr(api.tasks, "FETCH_BATCH_SIZE", 2)
+    problems = list(api.tasks.get_problems())
+
+    assert len(problems) == 3
+    assert "serialize it into a string." in problems[2][2]
+    assert "<p>" not in problems[0][2]
+    # Two batches, each one BODYSTRUCTURE fetch plus one text/plain section fetch
+    assert fake_imap.round_trips == 4
+
+
+def test_upgrade_resolves_duplicate_hashes():
+    """
+    Test the startup upgrade builds the unique hash index even when stored rows
+    share a normalized statement, and leaves the table alone once it is up to date.
+    """
+    from sqlalchemy import event, func, select, text
+
+    from api.migrations import upgrade
+    from api.tasks import engine
+
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        conn.execute(text("DROP INDEX ix_problems_content_hash"))
+        conn.execute(
+            text(
+                "UPDATE problems SET content_hash = "
+                "(SELECT content_hash FROM problems WHERE external_id = 1)"
+            )
+        )
+        upgrade(conn)
+        hashes = conn.scalar(select(func.count(func.distinct(Problem.content_hash))))
+        total = conn.scalar(select(func.count()).select_from(Problem))
+
+        statements = []
+        event.listen(conn, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        upgrade(conn)
+        transaction.rollback()
+
+    assert hashes == total
+    # Without pg_trgm installed only the CREATE EXTENSION attempt is repeated
+    assert not [s for s in statements if s.lstrip().startswith(("ALTER", "CREATE INDEX"))]
+
+
+def test_failed_messages_do_not_pin_sync_position(fake_imap):
+    """
+    Test the sync position advances past failed emails, which are fetched again on their
+    own until they reach MAX_MESSAGE_ATTEMPTS.
+    """
+    from sqlalchemy import delete
+
+    from api.models import FailedMessage, MailboxSync
+    from api.tasks import (
+        MAX_MESSAGE_ATTEMPTS,
+        Session,
+        finish_sync,
+        load_retry_uids,
+        new_problems,
+    )
+
+    with Session() as session:
+        sync_state = {"uidvalidity": None, "last_uid": 0}
+        assert len(list(new_problems(session, sync_state))) == 3
+        finish_sync(session, sync_state, [], {5: "Invalid schema"})
+        assert sync_state["last_uid"] == 9
+        assert load_retry_uids(session, sync_state) == [5]
+
+        for attempt in range(2, MAX_MESSAGE_ATTEMPTS + 1):
+            fake_imap.fetched.clear()
+            retry_uids = load_retry_uids(session, sync_state)
+            messages = list(new_problems(session, sync_state, retry_uids))
+            assert [uid for (uid, _, _), _ in messages] == [5]
+            assert set(fake_imap.fetched) == {5}
+            finish_sync(session, sync_state, retry_uids, {5: "Invalid schema"})
+        assert load_retry_uids(session, sync_state) == []
+        assert session.get(FailedMessage, ("INBOX", 5)).attempts == MAX_MESSAGE_ATTEMPTS
+
+        # A retried email that succeeds is forgotten
+        session.execute(delete(FailedMessage))
+        finish_sync(session, sync_state, [], {3: "Timeout"})
+        finish_sync(session, sync_state, [3], {})
+        assert session.query(FailedMessage).count() == 0
+
+        session.execute(delete(MailboxSync))
+        session.commit()
+
+
+def test_decode_part_unknown_charset():
+    """
+    Test a part declaring a charset Python does not know is decoded as utf-8.
+    """
+    from api.tasks import decode_part
+
+    assert decode_part("Caf\u00e9".encode(), "8bit", "x-unknown") == "Caf\u00e9"
+
+
+def test_sync_state_roundtrip():
+    """
+    Test the IMAP sync position is stored and updated in the database.
+    """
+    from api.tasks import Session, load_sync_state, save_sync_state
+
+    with Session() as session:
+        assert load_sync_state(session) == {"uidvalidity": None, "last_uid": 0}
+        save_sync_state(session, {"uidvalidity": 100, "last_uid": 9})
+        save_sync_state(session, {"uidvalidity": 100, "last_uid": 12})
+        session.commit()
+        assert load_sync_state(session) == {"uidvalidity": 100, "last_uid": 12}
+
+
+def test_new_problems_skips_duplicates_by_content_hash(fake_imap):
+    """
+    Test emails whose statement is already stored, up to whitespace, or repeated
+    within the same run are skipped.
+    """
+    from api.tasks import Session, new_problems
+
+    fake_imap.add(10, 4, "Given an  array\nof integers...")
+    fake_imap.add(11, 5, "Given a list of numbers,\n\nreturn whether any two sum to k.")
+
+    with Session() as session:
+        problem_ids = [problem_id for (_, problem_id, _), _ in new_problems(session)]
+    assert problem_ids == [1, 2, 3]
+
+
+def make_problem_values(external_id, problem, **extra):
+    return {
+        "external_id": external_id,
+        "title": f"Problem {external_id}",
+        "problem": problem,
+        "difficulty": "Easy",
+        "data_structures": [],
+        "algorithms": [],
+        "tags": [],
+        "edge_cases": [],
+        "input_types": [],
+        "output_types": [],
+        "test_cases": [],
+        "hints": [],
+        "solution": "",
+        "code_solution": "",
+        "source": "tests",
+        **extra,
+    }
+
+
+def test_insert_problems_ignores_duplicate_content():
+    """
+    Test inserting a statement that differs from a stored one only in whitespace is a no-op.
+    """
+    from api.tasks import Session, insert_problems
+
+    with Session() as session:
+        duplicate = make_problem_values(2, "Given  an array\tof integers...")
+        assert insert_problems(session, [duplicate]) == 0
+        new = make_problem_values(3, "A brand new statement.")
+        assert insert_problems(session, [duplicate, new]) == 1
+        session.rollback()
+
+
+def test_update_problems_keeps_derived_columns():
+    """
+    Test a Core update through update_problems() re-renders the stored JSON and rehashes
+    the statement of the updated rows only.
+    """
+    from sqlalchemy import select
+
+    from api.models import derived_columns
+    from api.tasks import Session, update_problems
+
+    with Session() as session:
+        before = session.execute(
+            select(Problem.id, Problem.rendered).where(Problem.id != 1)
+        ).all()
+        updated = update_problems(
+            session, Problem.id == 1, {"title": "Renamed", "problem": "A new statement."}
+        )
+        problem = session.get(Problem, 1)
+        stored = {
+            "rendered": problem.rendered,
+            "rendered_summary": problem.rendered_summary,
+            "content_hash": problem.content_hash,
+        }
+        expected = derived_columns(problem.to_dict())
+        after = session.execute(
+            select(Problem.id, Problem.rendered).where(Problem.id != 1)
+        ).all()
+        session.rollback()
+
+    assert updated == 1
+    assert json.loads(stored["rendered"])["title"] == "Renamed"
+    assert stored == expected
+    assert sorted(after) == sorted(before)
+
+
+def test_problem_writer_batches_and_isolates_bad_rows():
+    """
+    Test the writer commits full batches, flushes the remainder and skips a row
+    that makes its batch fail.
+    """
+    from sqlalchemy import delete, func, select
+
+    from api.tasks import ProblemWriter, Session
+
+    with Session() as session:
+        writer = ProblemWriter(session, batch_size=4, max_delay=60)
+        for i in range(5):
+            writer.add(make_problem_values(100 + i, f"Writer statement {i}", source="writer"))
+        assert writer.inserted == 4
+        writer.add(make_problem_values(None, "Statement without an id", source="writer"))
+        writer.add(make_problem_values(200, "Writer statement 0", source="writer"))
+        writer.flush()
+        assert (writer.inserted, writer.duplicates, writer.failed) == (5, 1, 1)
+
+        stored = session.scalar(
+            select(func.count()).select_from(Problem).where(Problem.source == "writer")
+        )
+        session.execute(delete(Problem).where(Problem.source == "writer"))
+        session.commit()
+    assert stored == 5
+
+
+def test_ingestion_run_metrics_pushed(fake_imap, fake_openai, monkeypatch, tmp_path):
+    """
+    Test a run times every stage, counts messages by outcome and pushes the summary.
+    """
+    from sqlalchemy import delete
+
+    import api.ingestion_metrics
+    import api.tasks
+    from api.models import MailboxSync
+
+    pushes = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_PUT(self):
+            body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+            pushes.append((self.path, body))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        api.ingestion_metrics, "METRICS_PUSHGATEWAY_URL", f"http://127.0.0.1:{server.server_port}"
+    )
+    monkeypatch.setattr(api.tasks, "OPENAI_API_KEY", "test")
+    monkeypatch.setattr(api.tasks, "OPENAI_BASE_URL", fake_openai.url)
+    monkeypatch.setattr(api.tasks, "OPENAI_RPM", 0)
+    monkeypatch.setattr(api.tasks, "CLASSIFICATION_CACHE_DIR", str(tmp_path))
+    # The same statement again is skipped by the dedup query
+    fake_imap.add(11, 4, "Given a list of numbers, return whether any two sum to k.")
+
+    with api.tasks.Session() as session:
+        session.execute(delete(MailboxSync))
+        session.commit()
+    try:
+        api.tasks.get_new_problems()
+    finally:
+        server.shutdown()
+        with api.tasks.Session() as session:
+            session.execute(delete(Problem).where(Problem.source == "Daily Coding Problem"))
+            session.execute(delete(MailboxSync))
+            session.commit()
+
+    [(path, text)] = pushes
+    assert path == "/metrics/job/coding_ingestion"
+    for outcome, value in (
+        ("scanned", 4),
+        ("duplicates", 1),
+        ("classified", 3),
+        ("inserted", 3),
+        ("failed", 0),
+    ):
+        assert f'ingestion_messages{{outcome="{outcome}"}} {value}' in text
+    for stage in api.ingestion_metrics.STAGES:
+        assert f'ingestion_stage_seconds{{stage="{stage}",quantile="0.95"}}' in text
+    assert 'ingestion_stage_calls{stage="classify"} 3' in text
+    assert 'ingestion_stage_calls{stage="imap_fetch"} 1' in text
+
+
+def test_ingestion_pipeline_memory_broker(fake_imap, fake_openai, monkeypatch, tmp_path):
+    """
+    Test fetch fans out one classify task per new email and persists them in one batch,
+    through an in-memory broker and an in-process worker, so messages and results
+    are serialized as in production.
+    """
+    import time
+
+    from celery.contrib.testing.worker import start_worker
+    from openai import OpenAI
+    from sqlalchemy import delete, select
+
+    import api.tasks
+    from api.cache import DiskCache
+    from api.models import MailboxSync
+
+    celery_app = api.tasks.app
+    monkeypatch.setattr(celery_app.conf, "CELERY_BROKER_URL", "memory://")
+    monkeypatch.setattr(celery_app.conf, "CELERY_RESULT_BACKEND", "cache+memory://")
+    monkeypatch.setattr(
+        api.tasks,
+        "worker_openai_client",
+        lambda: OpenAI(api_key="test", base_url=fake_openai.url, max_retries=0),
+    )
+    monkeypatch.setattr(api.tasks, "worker_rate_limiter", lambda: api.tasks.RateLimiter(0))
+    cache = DiskCache(str(tmp_path), max_bytes=1024 * 1024)
+    monkeypatch.setattr(api.tasks, "worker_classification_cache", lambda: cache)
+
+    with api.tasks.Session() as session:
+        session.execute(delete(MailboxSync))
+        session.commit()
+
+    with start_worker(celery_app, pool="solo", perform_ping_check=False):
+        api.tasks.fetch_new_problems.delay()
+        deadline = time.monotonic() + 30
+        with api.tasks.Session() as session:
+            while session.get(MailboxSync, "INBOX") is None and time.monotonic() < deadline:
+                time.sleep(0.1)
+                session.rollback()
+
+    with api.tasks.Session() as session:
+        titles = session.scalars(
+            select(Problem.title).where(Problem.source == "Daily Coding Problem")
+        ).all()
+        sync_state = api.tasks.load_sync_state(session)
+        session.execute(delete(Problem).where(Problem.source == "Daily Coding Problem"))
+        session.execute(delete(MailboxSync))
+        session.commit()
+
+    # The fake server echoes the prompt as the title, the first call was retried
+    assert len(titles) == 3
+    assert len(fake_openai.calls) == 4
+    assert sync_state == {"uidvalidity": 100, "last_uid": 9}
+
+
+def test_metadata_probes_run_concurrently(monkeypatch, tmp_path):
+    """
+    Test the provider is detected by concurrent probes without waiting for a slow one,
+    and the resolved attributes are reused from the disk cache.
+    """
+    import time
+
+    import api.settings
+
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            calls.append(self.path)
+            if self.path == "/slow":
+                time.sleep(1.5)
+            payload = json.dumps({"CODING_DB_NAME": " cloud_db "}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    cache_file = tmp_path / "metadata.json"
+    monkeypatch.setattr(
+        api.settings,
+        "METADATA_SOURCES",
+        {"oci": (f"{url}/slow", {}), "gcp": (f"{url}/fast", {})},
+    )
+    monkeypatch.setattr(api.settings, "METADATA_CACHE_FILE", str(cache_file))
+    api.settings.metadata_attributes.cache_clear()
+    try:
+        start = time.monotonic()
+        assert api.settings.metadata_attributes() == {"CODING_DB_NAME": "cloud_db"}
+        assert time.monotonic() - start < 1
+        assert cache_file.stat().st_mode & 0o777 == 0o600
+
+        api.settings.metadata_attributes.cache_clear()
+        calls.clear()
+        assert api.settings.metadata_attributes() == {"CODING_DB_NAME": "cloud_db"}
+        assert calls == []
+    finally:
+        api.settings.metadata_attributes.cache_clear()
+        server.shutdown()
+
+
+def test_failed_metadata_probe_retried_soon(monkeypatch, tmp_path):
+    """
+    Test an empty result of failed probes is cached for METADATA_EMPTY_CACHE_TTL only,
+    after which the attributes of a provider that answers again are picked up.
+    """
+    import time
+
+    import api.settings
+
+    failing = [True]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if failing[0]:
+                self.send_error(503)
+                return
+            payload = json.dumps({"CODING_DB_NAME": "cloud_db"}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cache_file = tmp_path / "metadata.json"
+    url = f"http://127.0.0.1:{server.server_port}/"
+    monkeypatch.setattr(api.settings, "METADATA_SOURCES", {"gcp": (url, {})})
+    monkeypatch.setattr(api.settings, "METADATA_CACHE_FILE", str(cache_file))
+    api.settings.metadata_attributes.cache_clear()
+    try:
+        assert api.settings.metadata_attributes() == {}
+        failing[0] = False
+        api.settings.metadata_attributes.cache_clear()
+        assert api.settings.metadata_attributes() == {}
+
+        # Past the short TTL of the empty result, well within METADATA_CACHE_TTL
+        cached = json.loads(cache_file.read_text())
+        cached["fetched_at"] = time.time() - api.settings.METADATA_EMPTY_CACHE_TTL - 1
+        cache_file.write_text(json.dumps(cached))
+        api.settings.metadata_attributes.cache_clear()
+        assert api.settings.metadata_attributes() == {"CODING_DB_NAME": "cloud_db"}
+        assert json.loads(cache_file.read_text())["provider"] == "gcp"
+    finally:
+        api.settings.metadata_attributes.cache_clear()
+        server.shutdown()
+
+
+def test_settings_import_time(tmp_path):
+    """
+    Test importing the settings with a warm metadata cache takes milliseconds and
+    sends no metadata requests, whatever variables are unset.
+    """
+    import subprocess
+    import sys
+    import time
+
+    cache_file = tmp_path / "metadata.json"
+    cache_file.write_text(
+        json.dumps({"provider": None, "attributes": {}, "fetched_at": time.time()})
+    )
+    env = {k: v for k, v in os.environ.items() if not k.startswith("CODING_")}
+    env["CODING_METADATA_CACHE_FILE"] = str(cache_file)
+    code = (
+        "import time, requests\n"
+        "def probe(*args, **kwargs):\n"
+        "    raise AssertionError('metadata probed')\n"
+        "requests.get = probe\n"
+        "start = time.perf_counter()\n"
+        "import api.settings\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+    )
+    assert float(result.stdout) < 0.5
@@ -1,14 +1,105 @@
-from sanic.exceptions import InvalidUsage
-from sanic.response import json, text
-from sqlalchemy import func, select
+import base64
+import binascii
+import hashlib
+import hmac
+import math
+import re
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from json import loads as json_loads
+
+from sanic.exceptions import Forbidden, InvalidUsage, NotFound
+from sanic.response import empty, json, json_dumps, raw
+from sqlalchemy import cast, func, or_, select, text
+from sqlalchemy.dialects.postgresql import REGCONFIG, array
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from api.app import app, get_session, read_engine
+from api.cache import get_catalog_state
+from api.facets import build_facets_query, collect_facets
+from api.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render_metrics
+from api.models import (
+    PROBLEM_FIELDS,
+    SUMMARY_FIELDS,
+    Problem,
+    DifficultyEnum,
+    with_id,
+)
+
+FILTER_PARAMS = (
+    "company",
+    "difficulty",
+    "search",
+    "data_structure",
+    "algorithm",
+    "tag",
+    "match",
+)
+LISTING_PARAMS = FILTER_PARAMS + (
+    "sort_order",
+    "limit",
+    "offset",
+    "after",
+    "before",
+    "fields",
+    "count",
+)
+# How /api/problems computes "total": exactly, from planner statistics, or not at all
+COUNT_MODES = ("exact", "estimate", "none")
+
+# Listing shapes that are served from the pre-rendered JSON columns
+RENDERED_COLUMNS = {None: Problem.rendered, SUMMARY_FIELDS: Problem.rendered_summary}
+
+# sitemaps.org protocol limit of URLs per file, larger catalogs get a sitemap index
+SITEMAP_URL_LIMIT = 50000
+SITEMAP_CHUNK_SIZE = 1000
+
+
+def search_query(search):
+    """Build a prefix tsquery so partial words match ('clim' finds 'climbing')."""
+    terms = " & ".join(f"{word}:*" for word in re.findall(r"\w+", search))
+    return func.to_tsquery(cast("english", REGCONFIG), terms)
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a select, for the planner's row estimate."""
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+async def estimate_count(session, filters):
+    """
+    Estimate how many problems match the filters without counting them: the table's
+    reltuples when unfiltered, the planner's row estimate otherwise. None before the
+    table was first analyzed.
+    """
+    if not filters:
+        result = await session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = 'problems'::regclass")
+        )
+        estimate = result.scalar()
+        return estimate if estimate >= 0 else None
 
-from api.app import app
-from api.models import Problem, DifficultyEnum
+    result = await session.execute(Explain(select(Problem.id).where(*filters)))
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json_loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
 
 
 def build_filters(request):
     """
-    Read query params (company, difficulty, data_structure, search, algorithm, tags)
+    Read query params (company, difficulty, search, data_structure, algorithm, tag, match)
     and return a list of SQLAlchemy filter expressions.
     """
     filters = []
@@ -26,198 +117,492 @@ def build_filters(request):
         except ValueError:
             raise InvalidUsage("Invalid difficulty value for filter")
 
-    # Filter by Title Search
+    # Full-text search over title, statement, hints and solution
     search = request.args.get("search")
     if search:
-        filters.append(Problem.title.ilike(f"%{search}%"))
+        condition = Problem.search_vector.op("@@")(search_query(search))
+        if request.app.ctx.trigram_search:
+            # Infix title matches, served by the trigram index
+            condition = or_(condition, Problem.title.ilike(f"%{search}%"))
+        filters.append(condition)
+
+    # Filter by Data Structures, Algorithms and Tags (JSONB arrays). Each param can
+    # be repeated, match=all (default) requires every value, match=any at least one.
+    match = request.args.get("match", "all")
+    if match not in {"all", "any"}:
+        raise InvalidUsage("Invalid match value for filter, use 'all' or 'any'")
+    for param, column in (
+        ("data_structure", Problem.data_structures),
+        ("algorithm", Problem.algorithms),
+        ("tag", Problem.tags),
+    ):
+        values = request.args.getlist(param)
+        if not values:
+            continue
+        if match == "all":
+            filters.append(column.contains(values))
+        else:
+            filters.append(column.has_any(array(values)))
 
-    # Filter by Data Structure
-    data_structure = request.args.get("data_structure")
-    if data_structure:
-        # For a JSONB column containing an array of data structures
-        filters.append(Problem.data_structures.contains([data_structure]))
+    return filters
 
-    # Filter by Algorithm
-    algorithm = request.args.get("algorithm")
-    if algorithm:
-        # For a JSONB column containing an array of algorithms
-        filters.append(Problem.algorithms.contains([algorithm]))
 
-    # Filter by Tags (multiple)
-    tag = request.args.get("tag")  # returns a list of all 'tags' params
-    if tag:
-        filters.append(Problem.tags.contains([tag]))
+def parse_int(request, name, default, minimum, maximum=None):
+    """Read an integer query parameter, rejecting values outside [minimum, maximum]."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise InvalidUsage(f"'{name}' must be an integer")
+    if number < minimum or (maximum is not None and number > maximum):
+        bounds = f"between {minimum} and {maximum}" if maximum is not None else f">= {minimum}"
+        raise InvalidUsage(f"'{name}' must be {bounds}")
+    return number
 
-    return filters
+
+def parse_fields(request):
+    """
+    Read the 'fields' query param: 'summary' or a comma separated list of fields.
+    Return the tuple of fields to select (always including id), or None for full rows.
+    """
+    fields = request.args.get("fields")
+    if not fields:
+        return None
+    if fields == "summary":
+        return SUMMARY_FIELDS
+
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in PROBLEM_FIELDS]
+    if unknown:
+        raise InvalidUsage(f"Unknown fields: {', '.join(unknown)}")
+    return ("id",) + tuple(dict.fromkeys(name for name in names if name != "id"))
+
+
+def encode_cursor(problem_id, sort_order):
+    """Encode the boundary id and sort direction as an opaque pagination token."""
+    return base64.urlsafe_b64encode(f"{sort_order}:{problem_id}".encode()).decode()
+
+
+def decode_cursor(token):
+    """Decode a pagination token into (problem_id, sort_order)."""
+    try:
+        sort_order, problem_id = base64.urlsafe_b64decode(token).decode().split(":")
+        problem_id = int(problem_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidUsage("Invalid pagination cursor")
+    if sort_order not in {"asc", "desc"}:
+        raise InvalidUsage("Invalid pagination cursor")
+    return problem_id, sort_order
+
+
+def cache_key(request, endpoint, params, version):
+    """Build a result cache key from the normalized query params and catalog version."""
+    normalized = tuple(
+        (name, tuple(sorted(request.args.getlist(name))))
+        for name in params
+        if name in request.args
+    )
+    return endpoint, version, normalized
+
+
+def etag_for(key):
+    """Derive a stable ETag from a cache key (which includes the catalog version)."""
+    return f'W/"{hashlib.sha1(repr(key).encode()).hexdigest()[:20]}"'
+
+
+def cached_json(body, hit, headers):
+    """Return an already serialized JSON body, flagging whether it came from cache."""
+    return raw(
+        body,
+        content_type="application/json",
+        headers={**headers, "X-Cache": "HIT" if hit else "MISS"},
+    )
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """Evaluate If-None-Match / If-Modified-Since against the current validators."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def cache_headers(request, etag, last_modified=None):
+    """Validators plus Cache-Control, so the proxy/CDN layer can serve repeat reads."""
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={request.app.config.CACHE_MAX_AGE}",
+    }
+    if last_modified:
+        headers["Last-Modified"] = format_datetime(
+            last_modified.astimezone(timezone.utc), usegmt=True
+        )
+    return headers
+
+
+def catalog_for(request, fields=None):
+    """The in-memory catalog index if it can answer this request, else None."""
+    catalog = request.app.ctx.catalog
+    if catalog is None or request.args.get("search") or fields not in RENDERED_COLUMNS:
+        return None
+    return catalog
+
+
+async def catalog_state(request, catalog):
+    """(version, updated_at) of the catalog, from the index when it serves the request."""
+    if catalog is not None:
+        return catalog.version, catalog.updated_at
+    return await get_catalog_state(get_session(request, readonly=True))
+
+
+def catalog_page(catalog, request, limit, offset, sort_order, cursor_id):
+    """
+    Return (ids, total) of a listing page from the catalog index, with one extra id
+    to tell whether there is a page past this one, in the order of the SQL query.
+    """
+    bits = catalog.match(request.args)
+    total = bits.bit_count()
+    ascending = sort_order == "asc"
+    if request.args.get("after"):
+        bits = catalog.after(bits, cursor_id) if ascending else catalog.before(bits, cursor_id)
+        return catalog.page(bits, limit + 1, descending=not ascending), total
+    if request.args.get("before"):
+        # Walk backwards from the cursor, the page is flipped back by the caller
+        bits = catalog.before(bits, cursor_id) if ascending else catalog.after(bits, cursor_id)
+        return catalog.page(bits, limit + 1, descending=ascending), total
+    return catalog.page(bits, limit + 1, offset, descending=not ascending), total
 
 
 @app.get("/api/facets")
 async def list_facets(request):
-    session = request.ctx.session
     filters = build_filters(request)
+    catalog = catalog_for(request)
 
-    # --- 1. Company Facets ---
-    company_stmt = (
-        select(Problem.company, func.count(Problem.id).label("cnt"))
-        .where(*filters)
-        .group_by(Problem.company)
-    )
-    result = await session.execute(company_stmt)
-    company_facets = [
-        {"value": row.company, "count": row.cnt}
-        for row in result.fetchall()
-        if row.company
-    ]
+    version, updated_at = await catalog_state(request, catalog)
+    key = cache_key(request, "facets", FILTER_PARAMS, version)
+    headers = cache_headers(request, etag_for(key), updated_at)
+    if is_not_modified(request, headers["ETag"], updated_at):
+        return empty(status=304, headers=headers)
 
-    # --- 2. Difficulty Facets ---
-    difficulty_stmt = (
-        select(Problem.difficulty, func.count(Problem.id).label("cnt"))
-        .where(*filters)
-        .group_by(Problem.difficulty)
-    )
-    result = await session.execute(difficulty_stmt)
-    difficulty_facets = [
-        {"value": row.difficulty, "count": row.cnt}
-        for row in result.fetchall()
-        if row.difficulty
-    ]
+    cache = request.app.ctx.result_cache
+    body = cache.get(key)
+    if body is not None:
+        return cached_json(body, hit=True, headers=headers)
 
-    # Sort difficulties in order: Easy, Medium, Hard
-    ORDER_MAP = {"Easy": 0, "Medium": 1, "Hard": 2}
-    difficulty_facets.sort(key=lambda item: ORDER_MAP.get(item["value"], 999))
-
-    # --- 3. Data Structures Facets (JSONB array) ---
-    ds_stmt = select(Problem.data_structures).where(*filters)
-    result = await session.execute(ds_stmt)
-    ds_count = {}
-    for row in result.fetchall():
-        ds_list = row[0]  # data_structures column
-        if ds_list and isinstance(ds_list, list):
-            for ds in ds_list:
-                ds_count[ds] = ds_count.get(ds, 0) + 1
-
-    data_structures_facets = [
-        {"value": ds, "count": count} for ds, count in ds_count.items()
-    ]
-    data_structures_facets.sort(key=lambda x: x["count"], reverse=True)
-
-    # --- 4. Algorithms Facets (JSONB array) ---
-    alg_stmt = select(Problem.algorithms).where(*filters)
-    result = await session.execute(alg_stmt)
-    alg_count = {}
-    for row in result.fetchall():
-        alg_list = row[0]  # algorithms column
-        if alg_list and isinstance(alg_list, list):
-            for alg in alg_list:
-                alg_count[alg] = alg_count.get(alg, 0) + 1
-
-    algorithms_facets = [
-        {"value": alg, "count": count} for alg, count in alg_count.items()
-    ]
-    algorithms_facets.sort(key=lambda x: x["count"], reverse=True)
-
-    # --- 5. Tags Facets (JSONB array) ---
-    tags_stmt = select(Problem.tags).where(*filters)
-    result = await session.execute(tags_stmt)
-    tags_count = {}
-    for row in result.fetchall():
-        tags_list = row[0]  # tags column
-        if tags_list and isinstance(tags_list, list):
-            for tag in tags_list:
-                tags_count[tag] = tags_count.get(tag, 0) + 1
-
-    tags_facets = [{"value": tag, "count": count} for tag, count in tags_count.items()]
-    tags_facets.sort(key=lambda x: x["count"], reverse=True)
-
-    # --- Return All Facets ---
-    return json(
-        {
-            "company": company_facets,
-            "difficulty": difficulty_facets,
-            "data_structures": data_structures_facets,
-            "algorithms": algorithms_facets,
-            "tags": tags_facets,
-        }
-    )
+    if catalog is not None:
+        facets = catalog.facets(catalog.match(request.args))
+    else:
+        result = await get_session(request, readonly=True).execute(build_facets_query(filters))
+        facets = collect_facets(result.fetchall())
+    body = json(facets).body
+    cache.set(key, body)
+    return cached_json(body, hit=False, headers=headers)
 
 
 @app.get("/api/problems")
 async def list_problems(request):
-    session = request.ctx.session
     filters = build_filters(request)
 
-    sort_order = request.args.get("sort_order", "asc").lower()
-    if sort_order not in {"asc", "desc"}:
+    # Search results are ordered by relevance unless a sort order is requested
+    search = request.args.get("search")
+    sort_order = request.args.get("sort_order", "relevance" if search else "asc").lower()
+    if sort_order not in {"asc", "desc", "relevance"} or (
+        sort_order == "relevance" and not search
+    ):
         sort_order = "asc"
 
-    limit = int(request.args.get("limit", 20))
-    offset = int(request.args.get("offset", 0))
+    limit = parse_int(request, "limit", 20, 1, request.app.config.MAX_PAGE_SIZE)
+    offset = parse_int(request, "offset", 0, 0)
+    fields = parse_fields(request)
+    count_mode = request.args.get("count", "exact")
+    if count_mode not in COUNT_MODES:
+        raise InvalidUsage(f"Invalid count value, use one of: {', '.join(COUNT_MODES)}")
+
+    # Keyset pagination: a cursor carries the boundary id and its own sort order
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if after and before:
+        raise InvalidUsage("Use either 'after' or 'before' cursor, not both")
+    cursor_id = None
+    if after or before:
+        cursor_id, sort_order = decode_cursor(after or before)
+
+    catalog = catalog_for(request, fields)
+    version, updated_at = await catalog_state(request, catalog)
+    key = cache_key(request, "problems", LISTING_PARAMS, version)
+    headers = cache_headers(request, etag_for(key), updated_at)
+    if is_not_modified(request, headers["ETag"], updated_at):
+        return empty(status=304, headers=headers)
+
+    cache = request.app.ctx.result_cache
+    body = cache.get(key)
+    if body is not None:
+        return cached_json(body, hit=True, headers=headers)
+
+    # Build the query with ordering and pagination. One extra row is fetched
+    # to find out whether there is a page past this one. Full and summary rows
+    # come pre-rendered, an explicit field list selects just those columns.
+    session = get_session(request, readonly=True)
+    ascending = sort_order == "asc"
+    rendered_column = RENDERED_COLUMNS.get(fields)
+    if rendered_column is not None:
+        query = select(Problem.id, rendered_column.label("rendered"))
+    else:
+        query = select(*(getattr(Problem, name) for name in fields))
+
+    total = None
+    if catalog is not None:
+        # The index picks the page ids and the total, only their bodies are read
+        ids, total = catalog_page(catalog, request, limit, offset, sort_order, cursor_id)
+        result = await session.execute(query.where(Problem.id.in_(ids)))
+        rows = {row.id: row for row in result}
+        problems = [rows[problem_id] for problem_id in ids if problem_id in rows]
+    else:
+        # Exact totals are kept per filter combination and catalog version, so
+        # further pages of the same listing don't count again
+        count_key = cache_key(request, "count", FILTER_PARAMS, version)
+        cached_total = cache.get(count_key)
+        if cached_total is not None:
+            total = int(cached_total)
+
+        # Otherwise the exact total comes back on every row of the page query, from a
+        # scalar subquery that Postgres plans on its own (bitmap, index-only or
+        # parallel scans). A count(*) OVER () window measured slower: it forces an
+        # id-ordered scan of every match, see benchmarks/count.py.
+        with_total = count_mode == "exact" and total is None
+        query = query.where(*filters)
+        if with_total:
+            total_query = select(func.count(Problem.id)).where(*filters)
+            query = query.add_columns(total_query.scalar_subquery().label("total"))
+        if after:
+            query = query.where(
+                Problem.id > cursor_id if ascending else Problem.id < cursor_id
+            ).order_by(Problem.id.asc() if ascending else Problem.id.desc())
+        elif before:
+            # Walk backwards from the cursor, the page is flipped back below
+            query = query.where(
+                Problem.id < cursor_id if ascending else Problem.id > cursor_id
+            ).order_by(Problem.id.desc() if ascending else Problem.id.asc())
+        elif sort_order == "relevance":
+            rank = func.ts_rank_cd(Problem.search_vector, search_query(search))
+            query = query.order_by(rank.desc(), Problem.id.asc()).offset(offset)
+        else:
+            query = query.order_by(
+                Problem.id.asc() if ascending else Problem.id.desc()
+            ).offset(offset)
+        result = await session.execute(query.limit(limit + 1))
+        problems = result.all()
+
+        if with_total and problems:
+            total = problems[0].total
+            cache.set(count_key, str(total).encode())
+
+    has_more = len(problems) > limit
+    problems = problems[:limit]
+    if before:
+        problems.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, bool(after) or offset > 0
+
+    # Cursors only apply to id ordering, relevance pages use offset
+    next_cursor = prev_cursor = None
+    if problems and sort_order != "relevance":
+        if has_next:
+            next_cursor = encode_cursor(problems[-1].id, sort_order)
+        if has_prev:
+            prev_cursor = encode_cursor(problems[0].id, sort_order)
+
+    # Count total number of records matching the filters, unless the page query
+    # already did or an estimate will do
+    if count_mode == "none":
+        total = None
+    elif total is None:
+        if count_mode == "estimate":
+            total = await estimate_count(session, filters)
+        if total is None:
+            # No estimate, or an empty page with no rows to carry the total
+            count_query = select(func.count(Problem.id)).where(*filters)
+            count_result = await session.execute(count_query)
+            total = count_result.scalar() or 0
+            cache.set(count_key, str(total).encode())
+
+    if rendered_column is not None:
+        problems_list = [with_id(row.id, row.rendered) for row in problems]
+    else:
+        problems_list = [
+            json_dumps({name: row._mapping[name] for name in fields}) for row in problems
+        ]
+    meta = json_dumps(
+        {"total": total, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
+    )
+    body = f'{{"problems":[{",".join(problems_list)}],{meta[1:]}'.encode()
+    cache.set(key, body)
+    return cached_json(body, hit=False, headers=headers)
 
-    # Build the query with ordering and pagination
-    query = (
-        select(Problem)
-        .where(*filters)
-        .order_by(Problem.id.asc() if sort_order == "asc" else Problem.id.desc())
-        .limit(limit)
-        .offset(offset)
+
+@app.get("/api/problems/<problem_id:int>")
+async def get_problem(request, problem_id):
+    # Served from the worker's record cache without touching the database. The
+    # validator is the body's own hash, so it only changes when the record does.
+    cache = request.app.ctx.problem_cache
+    body = cache.get(problem_id)
+    if body is None:
+        session = get_session(request, readonly=True)
+        result = await session.execute(
+            select(Problem.rendered).where(Problem.id == problem_id)
+        )
+        rendered = result.scalar_one_or_none()
+        if rendered is None:
+            return json({"error": "Problem not found"}, status=404)
+        body = with_id(problem_id, rendered).encode()
+        cache.set(problem_id, body)
+
+    headers = cache_headers(request, f'"{hashlib.sha1(body).hexdigest()[:20]}"')
+    if is_not_modified(request, headers["ETag"]):
+        return empty(status=304, headers=headers)
+    return raw(body, content_type="application/json", headers=headers)
+
+
+def sitemap_url(loc, priority):
+    return f"""
+        <url>
+            <loc>{loc}</loc>
+            <priority>{priority}</priority>
+        </url>"""
+
+
+def sitemap_index(domain, shards, last_modified):
+    lastmod = f"<lastmod>{last_modified.isoformat()}</lastmod>" if last_modified else ""
+    entries = "".join(
+        f"""
+        <sitemap>
+            <loc>{domain}/sitemap-{shard}.xml</loc>{lastmod}
+        </sitemap>"""
+        for shard in range(1, shards + 1)
     )
-    result = await session.execute(query)
-    problems = result.scalars().all()
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}
+</sitemapindex>"""
 
-    # Count total number of records matching the filters
-    count_query = select(func.count(Problem.id)).where(*filters)
-    count_result = await session.execute(count_query)
-    total = count_result.scalar() or 0
 
-    problems_list = [problem.to_dict() for problem in problems]
-    return json({"problems": problems_list, "total": total})
+async def send_sitemap(request, shard=None):
+    """
+    Serve the sitemap, or one shard of it once the catalog exceeds SITEMAP_URL_LIMIT.
 
+    Bodies are cached per catalog version, a cache miss is streamed to the client
+    in chunks while the problem ids are read from a server-side cursor.
+    """
+    session = get_session(request, readonly=True)
+    domain = request.app.config.DOMAIN
+    version, updated_at = await get_catalog_state(session)
+    headers = cache_headers(request, f'"sitemap-{version}-{shard or 0}"', updated_at)
+    if is_not_modified(request, headers["ETag"], updated_at):
+        return empty(status=304, headers=headers)
+
+    cache = request.app.ctx.sitemap_cache
+    key = ("sitemap", version, shard)
+    body = cache.get(key)
+    if body is not None:
+        return raw(body, content_type="application/xml", headers=headers)
+
+    # Static pages come first, followed by every problem ordered by id
+    static_urls = [
+        sitemap_url(f"{domain}/", "1.0"),
+        sitemap_url(f"{domain}/about", "0.8"),
+    ]
+    result = await session.execute(select(func.count(Problem.id)))
+    total = len(static_urls) + (result.scalar() or 0)
+    shards = math.ceil(total / SITEMAP_URL_LIMIT)
+
+    if shard is None and shards > 1:
+        body = sitemap_index(domain, shards, updated_at).encode()
+        cache.set(key, body)
+        return raw(body, content_type="application/xml", headers=headers)
+    if shard is not None and not 1 <= shard <= shards:
+        raise NotFound("Sitemap not found")
+
+    start = ((shard or 1) - 1) * SITEMAP_URL_LIMIT
+    end = start + SITEMAP_URL_LIMIT
+    query = (
+        select(Problem.id)
+        .order_by(Problem.id)
+        .offset(max(0, start - len(static_urls)))
+        .limit(end - max(start, len(static_urls)))
+    )
 
-@app.get("/api/problems/<problem_id:int>")
-async def get_problem(request, problem_id):
-    session = request.ctx.session
-    query = select(Problem).where(Problem.id == problem_id)
-    result = await session.execute(query)
-    problem = result.scalar_one_or_none()
-    if not problem:
-        return json({"error": "Problem not found"}, status=404)
-    return json(problem.to_dict())
+    response = await request.respond(content_type="application/xml", headers=headers)
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+        + "".join(static_urls[start:end])
+    ]
+    await response.send(parts[0])
+
+    # The request session is already committed once the response has started
+    async with AsyncSession(read_engine(request.app)) as stream_session:
+        result = await stream_session.stream_scalars(query)
+        async for ids in result.partitions(SITEMAP_CHUNK_SIZE):
+            chunk = "".join(
+                sitemap_url(f"{domain}/problems/{problem_id}", "0.8")
+                for problem_id in ids
+            )
+            parts.append(chunk)
+            await response.send(chunk)
+
+    parts.append("\n</urlset>")
+    await response.send(parts[-1])
+    await response.eof()
+    cache.set(key, "".join(parts).encode())
 
 
 @app.get("/sitemap.xml")
 async def sitemap_xml(request):
-    session = request.ctx.session
-    query = select(Problem.id)
-    result = await session.execute(query)
-    ids = [row[0] for row in result.fetchall()]
+    return await send_sitemap(request)
 
-    # Basic static pages
-    url_entries = [
-        f"""
-        <url>
-            <loc>{request.app.config.DOMAIN}/</loc>
-            <priority>1.0</priority>
-        </url>
-        <url>
-            <loc>{request.app.config.DOMAIN}/about</loc>
-            <priority>0.8</priority>
-        </url>
-        """
-    ]
-    for problem_id in ids:
-        url_entries.append(
-            f"""
-        <url>
-            <loc>{request.app.config.DOMAIN}/problems/{problem_id}</loc>
-            <priority>0.8</priority>
-        </url>
-        """
-        )
-    sitemap_content = f"""<?xml version="1.0" encoding="UTF-8"?>
-<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
-{''.join(url_entries)}
-</urlset>"""
-    return text(sitemap_content, content_type="application/xml")
+
+@app.get(r"/<shard:sitemap-(\d+)\.xml>")
+async def sitemap_shard_xml(request, shard):
+    return await send_sitemap(request, int(shard))
+
+
+@app.get("/api/cache/stats")
+async def cache_stats(request):
+    """Hit/miss counters and memory use of this worker's response and record caches."""
+    return json(
+        {
+            "result_cache": request.app.ctx.result_cache.stats(),
+            "sitemap_cache": request.app.ctx.sitemap_cache.stats(),
+            "problem_cache": request.app.ctx.problem_cache.stats(),
+            "compressed_cache": request.app.ctx.compressed_cache.stats(),
+        }
+    )
+
+
+@app.get("/metrics")
+async def metrics(request):
+    """Prometheus metrics of the whole server, see api/metrics.py."""
+    token = request.app.config.METRICS_TOKEN
+    if not token:
+        # The socket sits behind the public proxy, only a token tells scrapers apart
+        raise Forbidden("Metrics are disabled, set METRICS_TOKEN")
+    if not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {token}"):
+        raise Forbidden("Invalid metrics token")
+    return raw(
+        render_metrics(request.app.config.METRICS_DIR).encode(),
+        content_type=METRICS_CONTENT_TYPE,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,108 @@
+"""
+Compare SQL filtering and faceting with the in-memory bitset catalog index.
+
+For each size the catalog is seeded, the index is built from the same rows the
+server loads at startup, and facets and one listing page (ids plus total) are
+measured both ways. The index times include no database round trip.
+
+Usage: python -m benchmarks.catalog [--sizes 10000 100000 1000000] [--repeat 20]
+"""
+import argparse
+import sys
+import time
+
+from sanic.request import RequestParameters
+from sqlalchemy import func, select
+
+from api.catalog import CatalogIndex, facet_columns
+from api.facets import build_facets_query, collect_facets
+from api.models import Problem
+from benchmarks.common import get_engine, measure, seed
+
+SCENARIOS = {
+    "no filters": ({}, []),
+    "company=Google": ({"company": ["Google"]}, [Problem.company == "Google"]),
+    "data_structure=Array&algorithm=DFS": (
+        {"data_structure": ["Array"], "algorithm": ["DFS"]},
+        [Problem.data_structures.contains(["Array"]), Problem.algorithms.contains(["DFS"])],
+    ),
+}
+OFFSETS = (0, 5000)
+
+
+def sql_facets(conn, filters):
+    return collect_facets(conn.execute(build_facets_query(filters)).fetchall())
+
+
+def sql_page(conn, filters, offset):
+    page = conn.execute(
+        select(Problem.id).where(*filters).order_by(Problem.id).offset(offset).limit(21)
+    ).scalars().all()
+    total = conn.execute(select(func.count(Problem.id)).where(*filters)).scalar()
+    return page, total
+
+
+def index_page(index, args, offset):
+    bits = index.match(args)
+    return index.page(bits, 21, offset), bits.bit_count()
+
+
+def normalized(facets):
+    """Facets with every list sorted, SQL returns companies in no particular order."""
+    return {name: sorted(items, key=lambda item: item["value"]) for name, items in facets.items()}
+
+
+def index_size(index):
+    return sys.getsizeof(index.all) + sum(
+        sys.getsizeof(bits) for values in index.bitsets.values() for bits in values.values()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = get_engine()
+    for size in args.sizes:
+        seed(engine, size)
+        with engine.connect() as conn:
+            started = time.perf_counter()
+            index = CatalogIndex()
+            index.apply_rows(conn.execute(select(*facet_columns())))
+            load_ms = (time.perf_counter() - started) * 1000
+            print(
+                f"\n{size} problems: index built in {load_ms:.0f} ms, "
+                f"{index_size(index) / 1024 / 1024:.1f} MB"
+            )
+            print(f"{'scenario':<36} {'query':<14} {'impl':<7} {'median ms':>10} {'p95 ms':>9}")
+
+            for label, (params, filters) in SCENARIOS.items():
+                request_args = RequestParameters(params)
+                assert normalized(index.facets(index.match(request_args))) == normalized(
+                    sql_facets(conn, filters)
+                )
+                runs = [
+                    ("facets", "sql", lambda: sql_facets(conn, filters)),
+                    ("facets", "bitset", lambda: index.facets(index.match(request_args))),
+                ]
+                for offset in OFFSETS:
+                    assert index_page(index, request_args, offset) == sql_page(
+                        conn, filters, offset
+                    )
+                    runs += [
+                        (f"page@{offset}", "sql", lambda o=offset: sql_page(conn, filters, o)),
+                        (
+                            f"page@{offset}",
+                            "bitset",
+                            lambda o=offset: index_page(index, request_args, o),
+                        ),
+                    ]
+                for query, name, impl in runs:
+                    median, p95 = measure(impl, repeat=args.repeat)
+                    print(f"{label:<36} {query:<14} {name:<7} {median:10.3f} {p95:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Shared helpers for the benchmarks: a throwaway database and a synthetic catalog.
+
+Benchmarks run against a dedicated database (``bench_coding`` unless
+CODING_DB_NAME is set), because they drop and refill the ``problems`` table.
+"""
+import os
+import random
+import statistics
+import time
+
+if os.environ.get("CODING_DB_NAME") is None:
+    os.environ["CODING_DB_NAME"] = "bench_coding"
+
+from sqlalchemy import create_engine, insert  # noqa: E402
+
+from api.migrations import upgrade  # noqa: E402
+from api.models import Base, Problem, derived_columns  # noqa: E402
+from api.settings import SANIC_CONFIG  # noqa: E402
+
+COMPANIES = [
+    "Google", "Facebook", "Amazon", "Microsoft", "Apple", "Uber", "Airbnb",
+    "Twitter", "Stripe", "Dropbox", "Netflix", "LinkedIn", None,
+]
+DIFFICULTIES = ["Easy", "Medium", "Hard"]
+DATA_STRUCTURES = [
+    "Array", "String", "Hash Table", "Linked List", "Tree", "Binary Tree",
+    "Graph", "Heap", "Stack", "Queue", "Trie", "Matrix", "Set",
+]
+ALGORITHMS = [
+    "Two Pointers", "Sliding Window", "Binary Search", "DFS", "BFS",
+    "Dynamic Programming", "Greedy", "Backtracking", "Sorting", "Recursion",
+    "Divide and Conquer", "Bit Manipulation",
+]
+TAGS = ["In-Place", "Edge Cases", "Math", "Simulation", "Design", "Counting"]
+WORDS = (
+    "given array integers return list string tree node graph path sum maximum "
+    "minimum number find sorted matrix linked reverse kth element subarray "
+    "window distinct characters palindrome interval merge schedule cache"
+).split()
+SYLLABLES = ["ka", "lo", "mir", "ten", "su", "bar", "qui", "dor", "fen", "al", "zo", "ric"]
+
+
+def vocabulary(size=5000, seed_value=7):
+    """Common words first, then pseudo-words, so word frequency follows Zipf's law."""
+    rng = random.Random(seed_value)
+    words = list(WORDS)
+    seen = set(words)
+    while len(words) < size:
+        word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+VOCABULARY = vocabulary()
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+
+def get_engine():
+    return create_engine(
+        f"postgresql://{SANIC_CONFIG['DB_USER']}:{SANIC_CONFIG['DB_PASSWORD']}"
+        f"@{SANIC_CONFIG['DB_HOST']}/{SANIC_CONFIG['DB_DATABASE']}"
+    )
+
+
+def sentence(rng, length):
+    return " ".join(rng.choices(VOCABULARY, weights=WEIGHTS, k=length))
+
+
+def synthetic_problem(rng, n):
+    """Return column values for the n-th synthetic problem."""
+    values = {
+        "external_id": n,
+        "title": sentence(rng, 4).title(),
+        "problem": sentence(rng, 120),
+        "company": rng.choice(COMPANIES),
+        "source": "benchmark",
+        "difficulty": rng.choice(DIFFICULTIES),
+        "data_structures": rng.sample(DATA_STRUCTURES, rng.randint(1, 3)),
+        "algorithms": rng.sample(ALGORITHMS, rng.randint(0, 3)),
+        "tags": rng.sample(TAGS, rng.randint(0, 2)),
+        "time_complexity": "O(n)",
+        "space_complexity": "O(1)",
+        "passes_allowed": None,
+        "edge_cases": [sentence(rng, 4) for _ in range(3)],
+        "input_types": ["Array"],
+        "output_types": ["Integer"],
+        "test_cases": [{"input": "[1, 2, 3]", "output": "6"}],
+        "hints": [sentence(rng, 10) for _ in range(2)],
+        "solution": sentence(rng, 60),
+        "code_solution": "def solve(nums):\n    " + sentence(rng, 40),
+    }
+    values.update(derived_columns(values))
+    return values
+
+
+def seed(engine, size, seed_value=42, chunk=5000):
+    """Recreate the schema and fill it with ``size`` synthetic problems."""
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        upgrade(conn)
+
+    rng = random.Random(seed_value)
+    with engine.begin() as conn:
+        for start in range(0, size, chunk):
+            rows = [
+                synthetic_problem(rng, n)
+                for n in range(start, min(start + chunk, size))
+            ]
+            conn.execute(insert(Problem), rows)
+        conn.exec_driver_sql("ANALYZE problems")
+
+
+def measure(func, repeat=20, warmup=2):
+    """Run ``func`` and return (median, p95) wall time in milliseconds."""
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
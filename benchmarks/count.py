@@ -0,0 +1,135 @@
+"""
+Compare ways of returning an /api/problems page with its total: page plus separate
+count query, one statement with a scalar count subquery (count=exact), the same with a
+count(*) OVER () window, and planner estimates (count=estimate).
+
+The table is vacuumed after seeding, as autovacuum would have done in production,
+so index-only scans don't pay a heap fetch per row.
+
+Usage: python -m benchmarks.count [--sizes 10000 100000] [--repeat 20]
+"""
+import argparse
+
+from sqlalchemy import func, select, text
+
+from api.models import Problem
+from api.views import Explain
+from benchmarks.common import get_engine, measure, seed
+
+SCENARIOS = {
+    "no filters": [],
+    "company=Google": [Problem.company == "Google"],
+    "data_structure=Array": [Problem.data_structures.contains(["Array"])],
+}
+OFFSETS = (0, 5000)
+
+
+def two_queries(conn, filters, offset):
+    """The previous listing: the page, then a count of every matching row."""
+    page = conn.execute(
+        select(Problem.id, Problem.rendered_summary)
+        .where(*filters)
+        .order_by(Problem.id)
+        .offset(offset)
+        .limit(21)
+    ).all()
+    total = conn.execute(select(func.count(Problem.id)).where(*filters)).scalar()
+    return [row.id for row in page], total
+
+
+def fallback_total(conn, filters, page):
+    """Past the last match there is no row to carry the total, count separately as the view does."""
+    if page:
+        return page[0].total
+    return conn.execute(select(func.count(Problem.id)).where(*filters)).scalar()
+
+
+def single_statement(conn, filters, offset):
+    """count=exact: the total rides along on every row, from a scalar subquery."""
+    total = select(func.count(Problem.id)).where(*filters).scalar_subquery()
+    page = conn.execute(
+        select(Problem.id, Problem.rendered_summary, total.label("total"))
+        .where(*filters)
+        .order_by(Problem.id)
+        .offset(offset)
+        .limit(21)
+    ).all()
+    return [row.id for row in page], fallback_total(conn, filters, page)
+
+
+def windowed(conn, filters, offset):
+    """The window function alternative, which needs an id-ordered scan of every match."""
+    matches = (
+        select(Problem.id, func.count().over().label("total"))
+        .where(*filters)
+        .order_by(Problem.id)
+        .offset(offset)
+        .limit(21)
+        .subquery()
+    )
+    page = conn.execute(
+        select(Problem.id, Problem.rendered_summary, matches.c.total)
+        .join_from(matches, Problem, Problem.id == matches.c.id)
+        .order_by(matches.c.id)
+    ).all()
+    return [row.id for row in page], fallback_total(conn, filters, page)
+
+
+def estimated(conn, filters, offset):
+    """count=estimate: the plain page query plus pg_class or EXPLAIN."""
+    page = conn.execute(
+        select(Problem.id, Problem.rendered_summary)
+        .where(*filters)
+        .order_by(Problem.id)
+        .offset(offset)
+        .limit(21)
+    ).all()
+    if filters:
+        plan = conn.execute(Explain(select(Problem.id).where(*filters))).scalar()
+        total = plan[0]["Plan"]["Plan Rows"]
+    else:
+        total = conn.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = 'problems'::regclass")
+        ).scalar()
+    return [row.id for row in page], int(total)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = get_engine()
+    print(
+        f"{'size':<9} {'scenario':<22} {'offset':>6}  {'impl':<10} "
+        f"{'median ms':>10} {'p95 ms':>9}  total"
+    )
+    for size in args.sizes:
+        seed(engine, size)
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM ANALYZE problems")
+        with engine.connect() as conn:
+            for label, filters in SCENARIOS.items():
+                for offset in OFFSETS:
+                    expected = two_queries(conn, filters, offset)
+                    assert single_statement(conn, filters, offset) == expected
+                    assert windowed(conn, filters, offset) == expected
+                    for name, impl in (
+                        ("two", two_queries),
+                        ("single", single_statement),
+                        ("window", windowed),
+                        ("estimate", estimated),
+                    ):
+                        total = impl(conn, filters, offset)[1]
+                        median, p95 = measure(
+                            lambda: impl(conn, filters, offset), repeat=args.repeat
+                        )
+                        print(
+                            f"{size:<9} {label:<22} {offset:>6}  {name:<10} "
+                            f"{median:10.2f} {p95:9.2f}  {total}"
+                        )
+
+
+if __name__ == "__main__":
+    main()
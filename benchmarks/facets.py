@@ -0,0 +1,61 @@
+"""
+Compare the five-query /api/facets implementation with the single-statement one.
+
+Usage: python -m benchmarks.facets [--size 100000] [--repeat 20]
+"""
+import argparse
+
+from sqlalchemy import func, select
+
+from api.facets import build_facets_query, collect_facets
+from api.models import Problem
+from benchmarks.common import get_engine, measure, seed
+
+
+def legacy_facets(conn, filters):
+    """The previous implementation: one query per facet, arrays counted in Python."""
+    facets = {}
+    for name in ("company", "difficulty"):
+        column = getattr(Problem, name)
+        rows = conn.execute(
+            select(column, func.count(Problem.id)).where(*filters).group_by(column)
+        )
+        facets[name] = [{"value": v, "count": c} for v, c in rows if v]
+
+    for name in ("data_structures", "algorithms", "tags"):
+        counts = {}
+        for (values,) in conn.execute(select(getattr(Problem, name)).where(*filters)):
+            for value in values or []:
+                counts[value] = counts.get(value, 0) + 1
+        facets[name] = [{"value": v, "count": c} for v, c in counts.items()]
+    return facets
+
+
+def single_query_facets(conn, filters):
+    return collect_facets(conn.execute(build_facets_query(filters)).fetchall())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = get_engine()
+    seed(engine, args.size)
+
+    scenarios = {
+        "no filters": [],
+        "company=Google": [Problem.company == "Google"],
+        "data_structure=Array": [Problem.data_structures.contains(["Array"])],
+    }
+    print(f"{args.size} problems, median / p95 in ms")
+    with engine.connect() as conn:
+        for label, filters in scenarios.items():
+            for name, impl in (("legacy", legacy_facets), ("single", single_query_facets)):
+                median, p95 = measure(lambda: impl(conn, filters), repeat=args.repeat)
+                print(f"{label:<24} {name:<8} {median:9.1f} {p95:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Load-test the production server (run.py on a Unix socket) with 1, 2 and 4 workers.
+
+Each run seeds the benchmark database, starts ``python run.py`` with
+CODING_WEB_WORKERS set, and drives it from several client processes so the load
+generator is not the bottleneck. Throughput only scales up to the number of
+cores, so compare runs made on the same machine.
+
+Usage: python -m benchmarks.load [--workers 1 2 4] [--clients 4] [--seconds 10]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.common import get_engine, seed
+
+PATHS = [
+    "/api/problems?limit=20",
+    "/api/problems?limit=20&difficulty=Hard",
+    "/api/facets",
+    "/api/problems/1",
+]
+
+
+async def client_loop(socket_file, seconds, concurrency):
+    """Request PATHS round robin over `concurrency` connections, return latencies in ms."""
+    transport = httpx.AsyncHTTPTransport(uds=socket_file)
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def worker(offset):
+            nonlocal errors
+            n = offset
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                response = await client.get(PATHS[n % len(PATHS)])
+                latencies.append((time.perf_counter() - started) * 1000)
+                if response.status_code >= 400:
+                    errors += 1
+                n += 1
+
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return latencies, errors
+
+
+def run_client(args):
+    return asyncio.run(client_loop(*args))
+
+
+def wait_for_socket(socket_file, timeout=60):
+    deadline = time.monotonic() + timeout
+    with httpx.Client(transport=httpx.HTTPTransport(uds=socket_file)) as client:
+        while time.monotonic() < deadline:
+            try:
+                client.get("http://bench/api/facets")
+                return
+            except httpx.TransportError:
+                time.sleep(0.5)
+    raise TimeoutError(f"Server did not start on {socket_file}")
+
+
+def load_test(workers, clients, concurrency, seconds):
+    """Start the server with `workers` workers and return (req/s, p50, p99, errors)."""
+    socket_file = os.path.join(tempfile.mkdtemp(), "site.sock")
+    env = dict(
+        os.environ,
+        CODING_DEBUG="",
+        CODING_SOCKET_FILE=socket_file,
+        CODING_WEB_WORKERS=str(workers),
+        CODING_SOCKET_GROUP=os.environ.get("CODING_SOCKET_GROUP", "www-data"),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "run.py"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_socket(socket_file)
+        with multiprocessing.Pool(clients) as pool:
+            results = pool.map(run_client, [(socket_file, seconds, concurrency)] * clients)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(latency for result, _ in results for latency in result)
+    errors = sum(errors for _, errors in results)
+    return (
+        len(latencies) / seconds,
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.99) - 1],
+        errors,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    seed(get_engine(), args.size)
+    print(f"cpus: {os.cpu_count()}")
+    print("workers      req/s    p50 ms    p99 ms   errors")
+    for workers in args.workers:
+        rps, p50, p99, errors = load_test(
+            workers, args.clients, args.concurrency, args.seconds
+        )
+        print(f"{workers:<9} {rps:9.1f} {p50:9.2f} {p99:9.2f} {errors:8d}")
+
+
+if __name__ == "__main__":
+    main()
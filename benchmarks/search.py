@@ -0,0 +1,60 @@
+"""
+Compare the old title ILIKE scan with the indexed full-text search as the table grows.
+
+Usage: python -m benchmarks.search [--sizes 10000 50000 100000] [--repeat 20]
+"""
+import argparse
+
+from sqlalchemy import func, select
+
+from api.models import Problem
+from api.views import search_query
+from benchmarks.common import VOCABULARY, get_engine, measure, seed
+
+# A frequent word, a rare word and a prefix of a mid-frequency one
+TERMS = [VOCABULARY[40], VOCABULARY[3000], VOCABULARY[800][:4]]
+
+
+def ilike_search(conn, term):
+    """The previous search: title substring match, page plus total count."""
+    condition = Problem.title.ilike(f"%{term}%")
+    page = conn.execute(
+        select(Problem.id).where(condition).order_by(Problem.id).limit(20)
+    ).all()
+    total = conn.execute(select(func.count(Problem.id)).where(condition)).scalar()
+    return page, total
+
+
+def full_text_search(conn, term):
+    """Ranked full-text search on the GIN-indexed search_vector, page plus total count."""
+    query = search_query(term)
+    condition = Problem.search_vector.op("@@")(query)
+    page = conn.execute(
+        select(Problem.id)
+        .where(condition)
+        .order_by(func.ts_rank_cd(Problem.search_vector, query).desc(), Problem.id)
+        .limit(20)
+    ).all()
+    total = conn.execute(select(func.count(Problem.id)).where(condition)).scalar()
+    return page, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 50_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = get_engine()
+    print("size      term               impl        median ms    p95 ms")
+    for size in args.sizes:
+        seed(engine, size)
+        with engine.connect() as conn:
+            for term in TERMS:
+                for name, impl in (("ilike", ilike_search), ("fts", full_text_search)):
+                    median, p95 = measure(lambda: impl(conn, term), repeat=args.repeat)
+                    print(f"{size:<9} {term:<18} {name:<10} {median:10.2f} {p95:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Compare reads that build Problem objects and call to_dict() with pre-rendered JSON.
+
+Runs the database and serialization part of /api/problems/<id> and of a
+20-row /api/problems page through asyncpg, like the app does, and reports
+requests per second.
+
+Usage: python -m benchmarks.serialization [--size 10000] [--requests 2000]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from sanic.response import json_dumps
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from api.models import Problem, with_id
+from benchmarks.common import get_engine, seed
+
+
+async def detail_to_dict(session, problem_id):
+    problem = (
+        await session.execute(select(Problem).where(Problem.id == problem_id))
+    ).scalar_one()
+    return json_dumps(problem.to_dict()).encode()
+
+
+async def detail_rendered(session, problem_id):
+    rendered = (
+        await session.execute(select(Problem.rendered).where(Problem.id == problem_id))
+    ).scalar_one()
+    return with_id(problem_id, rendered).encode()
+
+
+async def page_to_dict(session, problem_id):
+    problems = (
+        await session.execute(
+            select(Problem).where(Problem.id >= problem_id).order_by(Problem.id).limit(20)
+        )
+    ).scalars()
+    return json_dumps({"problems": [problem.to_dict() for problem in problems]}).encode()
+
+
+async def page_rendered(session, problem_id):
+    rows = await session.execute(
+        select(Problem.id, Problem.rendered)
+        .where(Problem.id >= problem_id)
+        .order_by(Problem.id)
+        .limit(20)
+    )
+    items = ",".join(with_id(row.id, row.rendered) for row in rows)
+    return f'{{"problems":[{items}]}}'.encode()
+
+
+async def run(engine, impl, ids):
+    started = time.perf_counter()
+    async with AsyncSession(engine) as session:
+        for problem_id in ids:
+            await impl(session, problem_id)
+            session.expunge_all()
+    return len(ids) / (time.perf_counter() - started)
+
+
+async def main(args):
+    sync_engine = get_engine()
+    seed(sync_engine, args.size)
+    engine = create_async_engine(
+        sync_engine.url.set(drivername="postgresql+asyncpg"), pool_size=1
+    )
+
+    rng = random.Random(1)
+    ids = [rng.randint(1, args.size - 20) for _ in range(args.requests)]
+    print(f"{args.size} problems, {args.requests} sequential requests")
+    for label, before, after in (
+        ("detail", detail_to_dict, detail_rendered),
+        ("page of 20", page_to_dict, page_rendered),
+    ):
+        await run(engine, after, ids[:50])  # warm up
+        before_rps = await run(engine, before, ids)
+        after_rps = await run(engine, after, ids)
+        print(
+            f"{label:<12} to_dict {before_rps:8.0f} req/s   "
+            f"pre-rendered {after_rps:8.0f} req/s   x{after_rps / before_rps:.2f}"
+        )
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=2000)
+    asyncio.run(main(parser.parse_args()))
@@ -1,6 +1,7 @@
 import grp
 import os
 import socket
+import tempfile
 
 from sanic.log import logger
 
@@ -16,14 +17,25 @@ if __name__ == "__main__":
         except FileNotFoundError as e:
             logger.info(f"No old socket file found: {e}")
 
-        # Create socket and run app.
+        # Workers re-read the settings, so the metrics directory they all write
+        # their snapshots to is handed over in the environment.
+        if app.config["WEB_WORKERS"] > 1 and not app.config["METRICS_DIR"]:
+            os.environ["CODING_METRICS_DIR"] = tempfile.mkdtemp(prefix="coding-metrics-")
+
+        # Create socket and run app. The socket is bound once here and every worker
+        # accepts from it, shutdown drains requests for GRACEFUL_SHUTDOWN_TIMEOUT.
         with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
             try:
                 sock.bind(app.config["SOCKET_FILE"])
+                sock.set_inheritable(True)
 
                 os.chmod(app.config["SOCKET_FILE"], 0o775)
-                os.chown(app.config["SOCKET_FILE"], -1, grp.getgrnam("www-data").gr_gid)
+                os.chown(
+                    app.config["SOCKET_FILE"],
+                    -1,
+                    grp.getgrnam(app.config["SOCKET_GROUP"]).gr_gid,
+                )
 
-                app.run(sock=sock, access_log=False)
+                app.run(sock=sock, workers=app.config["WEB_WORKERS"], access_log=False)
             except OSError as e:
                 logger.warning(e)